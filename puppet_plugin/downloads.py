@@ -0,0 +1,409 @@
+""" Streaming downloads and a local on-disk cache for archives referenced
+by puppet_config.download.
+Downloads are written to disk in chunks and hashed on the fly. Interrupted
+transfers are resumed with HTTP Range requests.
+Cache blobs are stored by their SHA-256 digest. The index maps a download key
+(URL or blueprint resource path) to the blob and the HTTP validators
+(ETag/Last-Modified) which are used for conditional GETs. The index also
+remembers which digests were last extracted to which directory so that
+unchanged archives are not extracted again, and the per-file digests of
+the extracted tree which are used for delta syncs. """
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+import time
+
+import requests
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/cloudify-puppet/downloads')
+DEFAULT_CACHE_MAX_SIZE_MB = 512
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_RETRIES = 3
+INDEX_FILE = 'index.json'
+LOCK_FILE = '.lock'
+
+
+class DownloadError(RuntimeError):
+    """ Failed to download an archive """
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _content_length(response):
+    try:
+        return int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _rewind(f):
+    try:
+        f.seek(0)
+        f.truncate()
+    except IOError as exc:
+        # For example when writing to a pipe
+        raise DownloadError("Can not restart the download: {0}".format(exc))
+
+
+def stream_download(url, f, headers=None, chunk_size=None, retries=None,
+                    expected_digest=None):
+    """
+    Writes the body of GET `url` to the file object `f` chunk by chunk.
+    Interrupted transfers are resumed with a Range request (unless the
+    body is content-encoded) up to `retries` times. `f` may be a pipe as
+    long as the transfer does not have to start over.
+    Returns (first response, SHA-256 hex digest of the body). If the first
+    response is not 200 (for example 304 for a conditional GET), nothing
+    is written and the digest is None.
+    Raises DownloadError on failure or if `expected_digest` does not match.
+    """
+    chunk_size = int(chunk_size or DEFAULT_CHUNK_SIZE)
+    if retries is None:
+        retries = DEFAULT_RETRIES
+    digest = hashlib.sha256()
+    written = 0
+    total = None
+    first = None
+    validator = None
+    resumable = False
+    request_headers = dict(headers or {})
+    error = None
+    for _ in range(int(retries) + 1):
+        try:
+            response = requests.get(url, headers=request_headers, stream=True)
+        except requests.RequestException as exc:
+            error = exc
+            continue
+        try:
+            if first is None:
+                first = response
+                if response.status_code != requests.codes.ok:
+                    return response, None
+                total = _content_length(response)
+                validator = (response.headers.get('ETag') or
+                             response.headers.get('Last-Modified'))
+                resumable = 'Content-Encoding' not in response.headers
+            elif response.status_code != requests.codes.partial_content:
+                if response.status_code != requests.codes.ok:
+                    raise DownloadError(
+                        "Failed to download {0}: HTTP {1}".format(
+                            url, response.status_code))
+                # Server ignored the Range header, start over
+                _rewind(f)
+                digest = hashlib.sha256()
+                written = 0
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+            except requests.RequestException as exc:
+                error = exc
+            else:
+                if not resumable or total is None or written >= total:
+                    break
+                error = DownloadError("Got {0} of {1} bytes".format(
+                    written, total))
+        finally:
+            response.close()
+        if resumable and written:
+            request_headers = {'Range': 'bytes={0}-'.format(written)}
+            if validator:
+                request_headers['If-Range'] = validator
+        else:
+            _rewind(f)
+            digest = hashlib.sha256()
+            written = 0
+            request_headers = dict(headers or {})
+            first = None
+    else:
+        raise DownloadError("Failed to download {0}: {1}".format(url, error))
+
+    f.flush()
+    digest = digest.hexdigest()
+    if expected_digest and digest != expected_digest.lower():
+        raise DownloadError("Checksum mismatch for {0}: expected {1}, "
+                            "got {2}".format(url, expected_digest, digest))
+    return first, digest
+
+
+def _member_path(name, strip_prefix):
+    """ Same as tar's --xform 's#^<strip_prefix>/##'. Returns None for
+    unsafe names """
+    if name.startswith(strip_prefix + '/'):
+        name = name[len(strip_prefix) + 1:]
+    name = name.rstrip('/')
+    while name.startswith('./'):
+        name = name[2:]
+    if not name or name == '.' or name.startswith('/') or \
+            '..' in name.split('/'):
+        return None
+    return name
+
+
+def write_archives_delta(archives, strip_prefix, previous, open_out):
+    """
+    Compares the contents of .tar.gz `archives` (later archives override
+    earlier ones) with `previous` ({path: digest}) and writes the members
+    which differ as an uncompressed tar stream to the file object returned
+    by `open_out()`. `open_out` is only called if something changed.
+    Returns (current {path: digest}, changed paths, deleted paths)
+    """
+    current = {}
+    changed = []
+    out = []
+
+    def out_tar():
+        if not out:
+            out.append(tarfile.open(fileobj=open_out(), mode='w|'))
+        return out[0]
+
+    # Going backwards, the first member seen for a path wins
+    for archive in reversed(archives):
+        src = tarfile.open(archive, mode='r|gz')
+        for member in src:
+            path = _member_path(member.name, strip_prefix)
+            if path is None or path in current:
+                continue
+            data = None
+            h = hashlib.sha256()
+            h.update('{0}:{1:o}:'.format(member.type, member.mode))
+            if member.isfile():
+                data = tempfile.SpooledTemporaryFile(1024 * 1024)
+                f = src.extractfile(member)
+                for chunk in iter(lambda: f.read(DEFAULT_CHUNK_SIZE), b''):
+                    h.update(chunk)
+                    data.write(chunk)
+                data.seek(0)
+            elif member.issym() or member.islnk():
+                linkname = member.linkname
+                if member.islnk():
+                    linkname = _member_path(linkname, strip_prefix)
+                    if linkname is None:
+                        continue
+                    member.linkname = linkname
+                h.update(linkname)
+            current[path] = h.hexdigest()
+            if member.isdir():
+                # Directories are never deleted, only created
+                current[path] = 'dir:' + current[path]
+            if previous.get(path) != current[path]:
+                member.name = path
+                changed.append(path)
+                # Write before reading the next member, the source is a
+                # stream
+                out_tar().addfile(member, data)
+            if data:
+                data.close()
+        src.close()
+    if out:
+        out[0].close()
+
+    deleted = sorted(
+        path for path, digest in previous.items()
+        if path not in current and not digest.startswith('dir:'))
+    return current, sorted(changed), deleted
+
+
+def _key_id(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class DownloadCache(object):
+
+    def __init__(self, logger, directory=None, max_size_mb=None,
+                 chunk_size=None, retries=None, checksums=None):
+        self.logger = logger
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.checksums = checksums or {}
+        self.directory = directory or DEFAULT_CACHE_DIR
+        if max_size_mb is None:
+            max_size_mb = DEFAULT_CACHE_MAX_SIZE_MB
+        self.max_size = int(max_size_mb) * 1024 * 1024
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @classmethod
+    def from_props(cls, logger, props):
+        """ Builds the cache from puppet_config.download_cache """
+        conf = props.get('download_cache', {})
+        return cls(logger, conf.get('dir'), conf.get('max_size_mb'),
+                   chunk_size=props.get('download_chunk_size'),
+                   retries=props.get('download_retries'),
+                   checksums=props.get('download_checksums'))
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest + '.tar.gz')
+
+    @contextlib.contextmanager
+    def _index(self):
+        """ Locked read-modify-write access to the index """
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index_path = os.path.join(self.directory, INDEX_FILE)
+            try:
+                with open(index_path) as f:
+                    index = json.load(f)
+            except (IOError, ValueError):
+                index = {}
+            index.setdefault('entries', {})
+            index.setdefault('extracted', {})
+            index.setdefault('trees', {})
+            yield index
+            with tempfile.NamedTemporaryFile(dir=self.directory,
+                                             delete=False) as f:
+                json.dump(index, f)
+            os.rename(f.name, index_path)
+
+    def _lookup(self, key):
+        with self._index() as index:
+            entry = index['entries'].get(_key_id(key))
+            if entry and not os.path.exists(self.blob_path(entry['digest'])):
+                del index['entries'][_key_id(key)]
+                entry = None
+            return entry
+
+    def _verify(self, key, digest):
+        expected = self.checksums.get(key)
+        if expected and digest != expected.lower():
+            raise DownloadError("Checksum mismatch for {0}: expected {1}, "
+                                "got {2}".format(key, expected, digest))
+
+    def _store(self, key, temp_path, digest, validators=None):
+        """ Moves downloaded `temp_path` into the cache under `key` """
+        os.rename(temp_path, self.blob_path(digest))
+        entry = {
+            'key': key,
+            'digest': digest,
+            'size': os.path.getsize(self.blob_path(digest)),
+            'atime': time.time(),
+        }
+        entry.update(validators or {})
+        with self._index() as index:
+            index['entries'][_key_id(key)] = entry
+        return entry
+
+    def _touch(self, key):
+        with self._index() as index:
+            index['entries'][_key_id(key)]['atime'] = time.time()
+
+    def _temp_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.directory,
+                                           suffix='.part', delete=False)
+
+    def fetch_url(self, url):
+        """ Returns (blob path, digest) for `url`, using a conditional GET
+        when the URL is already in the cache """
+        entry = self._lookup(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        with self._temp_file() as f:
+            try:
+                response, digest = stream_download(
+                    url, f, headers, self.chunk_size, self.retries,
+                    self.checksums.get(url))
+            except DownloadError:
+                os.remove(f.name)
+                raise
+        if entry and response.status_code == requests.codes.not_modified:
+            os.remove(f.name)
+            self.logger.info("Using cached {0} ({1})".format(
+                url, entry['digest']))
+            self._verify(url, entry['digest'])
+            self._touch(url)
+            return self.blob_path(entry['digest']), entry['digest']
+        if response.status_code != requests.codes.ok:
+            os.remove(f.name)
+            raise DownloadError("Failed to download {0}: HTTP {1}".format(
+                url, response.status_code))
+        entry = self._store(url, f.name, digest, {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        })
+        return self.blob_path(entry['digest']), entry['digest']
+
+    def fetch_resource(self, ctx, path):
+        """ Returns (blob path, digest) for blueprint resource `path`.
+        Resources have no validators so the resource is downloaded and
+        the cache is keyed by resource path plus content digest. """
+        with self._temp_file() as f:
+            pass
+        ctx.download_resource(path, f.name)
+        digest = _file_digest(f.name)
+        try:
+            self._verify(path, digest)
+        except DownloadError:
+            os.remove(f.name)
+            raise
+        entry = self._lookup('resource:' + path)
+        if entry and entry['digest'] == digest:
+            os.remove(f.name)
+            self.logger.info("Resource {0} is unchanged ({1})".format(
+                path, digest))
+            self._touch('resource:' + path)
+        else:
+            entry = self._store('resource:' + path, f.name, digest)
+        return self.blob_path(entry['digest']), entry['digest']
+
+    def is_extracted(self, dst_dir, digests):
+        """ Were exactly `digests` (in this order) the last archives
+        extracted to `dst_dir`? """
+        with self._index() as index:
+            return (os.path.isdir(dst_dir) and
+                    index['extracted'].get(dst_dir) == list(digests))
+
+    def set_extracted(self, dst_dir, digests):
+        with self._index() as index:
+            index['extracted'][dst_dir] = list(digests)
+
+    def get_tree(self, dst_dir):
+        """ Returns {path: digest} of the files last synced to `dst_dir` """
+        with self._index() as index:
+            return index['trees'].get(dst_dir, {})
+
+    def set_tree(self, dst_dir, tree):
+        with self._index() as index:
+            index['trees'][dst_dir] = tree
+
+    def evict(self):
+        """ Removes least recently used blobs until the cache fits
+        into its size limit """
+        with self._index() as index:
+            entries = sorted(index['entries'].items(),
+                             key=lambda kv: kv[1]['atime'])
+            total = sum(e['size'] for _, e in entries)
+            for key_id, entry in entries:
+                if total <= self.max_size:
+                    break
+                total -= entry['size']
+                del index['entries'][key_id]
+                in_use = [e for e in index['entries'].values()
+                          if e['digest'] == entry['digest']]
+                if not in_use:
+                    self.logger.info("Evicting {0} from download cache".
+                                     format(entry['key']))
+                    try:
+                        os.remove(self.blob_path(entry['digest']))
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
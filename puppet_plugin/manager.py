@@ -2,18 +2,37 @@
 # https://github.com/CloudifySource/cloudify-recipes/blob/
 # 991ab4ce0596930836f7d4e33f6f9bd70894d85a/
 # services/puppet/PuppetBootstrap.groovy
+import collections
+import contextlib
+import copy
 import datetime
+import difflib
+import fcntl
+import hashlib
 import json
 import os
 import platform
+import random
 import re
+import shutil
+import socket
 import subprocess
+import tarfile
 import tempfile
+import threading
+import time
 import urlparse
+from multiprocessing.pool import ThreadPool
 
 import requests
 from cloudify.exceptions import NonRecoverableError
 
+from puppet_plugin.downloads import (DownloadCache,
+                                     DownloadError,
+                                     stream_download,
+                                     write_archives_delta)
+from puppet_plugin.sudo_helper import SudoHelper, SudoHelperError
+
 PUPPET_CONF_TPL = """# This file was generated by Cloudify
 [main]
     ssldir = /var/lib/puppet/ssl
@@ -31,16 +50,170 @@ PUPPET_CONF_TPL = """# This file was generated by Cloudify
     node_name_value = {node_name}
 """
 
+PUPPET_CONF_FILE = '/etc/puppet/puppet.conf'
+APT_LISTS_DIR = '/var/lib/apt/lists'
+APT_SOURCES_LIST = '/etc/apt/sources.list'
+APT_SOURCES_PARTS = '/etc/apt/sources.list.d'
+INI_SECTION_RE = re.compile(r'^\s*\[([^\]]+)\]\s*$')
+INI_SETTING_RE = re.compile(r'^(\s*)([^#;=\s][^=]*?)\s*=\s*(.*?)\s*$')
+
+# Used with puppet_config.agent_daemon. The daemon is started with the
+# tags of the operation and is restarted when the tags change. Other runs
+# are triggered with SIGUSR1. The exit code is calculated from the run
+# summary, same as --detailed-exitcodes of the one time run.
+AGENT_DAEMON_RUN_TPL = """#!/bin/bash -e
+pidfile={pidfile}
+tagsfile={tagsfile}
+tags='{tags}'
+summary=/var/lib/puppet/state/last_run_summary.yaml
+marker=$(mktemp)
+cleanup=$marker
+trap 'rm -f $cleanup' EXIT
+{facts_setup}{environ}
+running() {{ [ -f $pidfile ] && kill -0 $(cat $pidfile) 2>/dev/null; }}
+if running && [ "$(cat $tagsfile 2>/dev/null)" != "$tags" ]; then
+    kill $(cat $pidfile)
+    while running; do sleep 0.5; done
+fi
+if running; then
+    kill -USR1 $(cat $pidfile)
+else
+    echo "$tags" > $tagsfile
+    # The daemon must not hold the external facts lock (fd 9)
+    {cmd} 9>&-
+fi
+e=0
+wait_cmd="while [[ ! $summary -nt $marker ]]; do sleep 0.5; done"
+timeout {timeout} bash -c "$wait_cmd" || e=1
+if [ $e -eq 0 ];then
+    cat $summary
+    section_value() {{
+        awk -v s="$1:" -v k="$2:" \\
+            'NF==1{{c=$1}} NF==2 && c==s && $1==k{{print $2}}' $summary
+    }}
+    if [ "$(section_value events failure)" != 0 ] ||
+       [ "$(section_value resources failed)" != 0 ];then
+        e=4
+    fi
+fi
+echo Exit code: $e
+exit $e
+"""
+# Used with puppet_config.facts_format 'external'. Runs which use external
+# facts are serialized so that each run sees only its own facts file. The
+# lock is held on fd 9 until the run script exits, long running processes
+# started by the script must close it.
+EXTERNAL_FACTS_SETUP_TPL = """exec 9>{lock}
+flock 9
+mkdir -p {facts_dir}
+cleanup="$cleanup {dst}"
+trap 'rm -f $cleanup' EXIT
+cp {facts_file} {dst}
+"""
+EXTERNAL_FACTS_LOCK = '/opt/cloudify/puppet/external_facts.lock'
+DEFAULT_EXTERNAL_FACTS_DIR = '/etc/facter/facts.d'
+
+AGENT_DAEMON_FILES = {
+    'pid': '/opt/cloudify/puppet/agent.pid',
+    'tags': '/opt/cloudify/puppet/agent.tags',
+    'facts': '/opt/cloudify/puppet/agent_facts.json',
+}
+# The daemon only runs when triggered
+AGENT_DAEMON_RUNINTERVAL = 365 * 24 * 60 * 60
+DEFAULT_AGENT_DAEMON_TIMEOUT = 60 * 60
+
+# Admission control of agent runs, see puppet_config.agent_concurrency and
+# puppet_config.master_retries
+AGENT_TOKENS_DIR = os.path.expanduser('~/.cache/cloudify-puppet/agent_tokens')
+AGENT_TOKEN_POLL_INTERVAL = 1
+DEFAULT_MASTER_RETRY_DELAY = 10
+MASTER_RETRY_MAX_DELAY = 300
+# puppet_config.ssl_preseed: SSL material installed instead of requesting
+# a certificate from the master. {key: (path, mode)}
+PUPPET_SSL_DIR = '/var/lib/puppet/ssl'
+PUPPET_SSL_FILES = {
+    'certificate': ('certs/{certname}.pem', '644'),
+    'private_key': ('private_keys/{certname}.pem', '600'),
+    'ca_certificate': ('certs/ca.pem', '644'),
+}
+# Read by the agent when it creates its CSR, used by policy based autosigning
+CSR_ATTRIBUTES_FILE = '/etc/puppet/csr_attributes.yaml'
+
+# puppet_config.server can be a list of masters, see get_servers()
+SERVER_POLICIES = ('hash', 'latency', 'ordered')
+PUPPET_MASTER_PORT = 8140
+SERVER_PROBE_TIMEOUT = 2
+# Transient failures of the agent which are caused by a busy or
+# unreachable master. Other catalog retrieval failures, such as "Error 400
+# on SERVER" for compilation errors, fail the same way on every master.
+# Only the errors of the requests to the master are matched: resources
+# which fail with the same messages are not the master's fault.
+MASTER_ERROR_RE = re.compile(
+    r'(Could not retrieve catalog from remote server|'
+    r'Could not request certificate): '
+    r'(Error 5[0-9][0-9] on SERVER|'
+    r'execution expired|'
+    r'Connection timed out|'
+    r'Connection refused|'
+    r'Connection reset by peer)')
+
 PUPPET_CONF_MODULE_PATH = [
     '/etc/puppet/modules',
     '/usr/share/puppet/modules',
     '/opt/cloudify/puppet/modules',
     # {cloudify_module_path}
 ]
+RUN_STATE_DIR = os.path.expanduser('~/.cache/cloudify-puppet/runs')
+DEFAULT_RUN_FINGERPRINT_TTL = 24 * 60 * 60
+INSTALL_STATE_FILE = os.path.expanduser(
+    '~/.cache/cloudify-puppet/puppet_installed')
+
+CUSTOM_FACTS_FILE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'puppet', 'facts', 'cloudify_facts.rb')
+# Describes what a pre-baked image contains, see get_image_manifest()
+IMAGE_MANIFEST_FILE = '/etc/cloudify/puppet-image.json'
+
+REPORT_SUMMARY_SCRIPT = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'puppet', 'report_summary.rb')
+PUPPET_LAST_RUN_REPORT = '/var/lib/puppet/state/last_run_report.yaml'
+DEFAULT_REPORT_TOP = 10
+
+# "Info: PROFILE [apply] 1.2 Evaluated resource Class[X]: took 0.1 seconds"
+PROFILE_LINE_RE = re.compile(
+    r'PROFILE \[[^\]]*\] [\d.]+ (.*): took ([\d.]+) seconds')
+# "Info: /Stage[main]/Apache/Package[httpd]: Evaluated in 2.31 seconds"
+EVALTRACE_LINE_RE = re.compile(
+    r'([A-Z][\w:]*\[[^\]]*\]): Evaluated in ([\d.]+) seconds')
+PROFILE_CATEGORIES = ('class', 'defined type', 'resource', 'function',
+                      'other')
+DEFAULT_PROFILE_TOP = 20
+
+# See cloudify_facts.rb
+FACTS_FORMATS = ('nested', 'flat', 'structured', 'external')
+
+# Runtime properties set by the plugin itself, they are not inputs of runs
+PLUGIN_RUNTIME_PROPERTIES = ('puppet_batch_runs', 'puppet_last_run',
+                             'puppet_certname')
+
+# Output of commands is logged in batches, the tail is kept for errors
+OUTPUT_LOG_INTERVAL = 1
+OUTPUT_LOG_MAX_LINES = 50
+# Seconds to keep reading the output of a command after it exited
+OUTPUT_DRAIN_TIMEOUT = 2
+SUDO_OUTPUT_TAIL_LINES = 100
+
+# Per process cache of the platform probes and of the classes
+# assembled by PuppetManager()
+_PROCESS_CACHE = {}
+
 # docs.puppetlabs.com/puppet/latest/reference/lang_reserved.html#tags
 PUPPET_TAG_RE = re.compile('\A[a-z0-9_][a-z0-9_:\.\-]*\Z')
 # docs.puppetlabs.com/puppet/latest/reference/lang_reserved.html#environments
 PUPPET_ENV_RE = re.compile('\A[a-z0-9]+\Z')
+# docs.puppetlabs.com/puppet/latest/reference/modules_publishing.html
+PUPPET_MODULE_NAME_RE = re.compile(r'\A[A-Za-z0-9]+[-/][a-z][a-z0-9_]*\Z')
 
 
 def quote_shell_arg(s):
@@ -57,6 +230,168 @@ def is_resource_url(url):
     return (not u.scheme), u.path
 
 
+def unsafe_tar_members(tar):
+    """ Names of the members of the TarFile `tar` which are not regular
+    files or directories or which would be extracted outside of the
+    target directory """
+    ret = []
+    for member in tar.getmembers():
+        parts = member.name.split('/')
+        if (not (member.isfile() or member.isdir()) or
+                os.path.isabs(member.name) or '..' in parts):
+            ret.append(member.name)
+    return ret
+
+
+def parse_profile(output):
+    """
+    Aggregates the output of a run with --profile and --evaltrace.
+    Returns {(category, name): [count, total seconds]} where category is
+    one of 'class', 'defined type', 'resource', 'function' or 'other'
+    """
+    ret = {}
+
+    def add(category, name, seconds):
+        entry = ret.setdefault((category, name), [0, 0.0])
+        entry[0] += 1
+        entry[1] += float(seconds)
+
+    for line in output.splitlines():
+        m = PROFILE_LINE_RE.search(line)
+        if m:
+            what, seconds = m.groups()
+            if what.startswith('Evaluated resource '):
+                name = what[len('Evaluated resource '):]
+                if name.startswith('Class['):
+                    add('class', name, seconds)
+                else:
+                    add('defined type', name, seconds)
+            elif what.startswith('Called '):
+                add('function', what[len('Called '):], seconds)
+            else:
+                add('other', what, seconds)
+            continue
+        m = EVALTRACE_LINE_RE.search(line)
+        if m:
+            add('resource', m.group(1), m.group(2))
+    return ret
+
+
+def format_profile_table(profile, top):
+    """ Table of the `top` slowest entries of each category """
+    lines = []
+    for category in PROFILE_CATEGORIES:
+        entries = sorted(
+            ((name, count, total)
+             for (c, name), (count, total) in profile.items()
+             if c == category),
+            key=lambda entry: -entry[2])[:top]
+        if not entries:
+            continue
+        lines.append('{0:>10}  {1:>6}  {2}'.format(
+            'seconds', 'count', category.upper()))
+        for name, count, total in entries:
+            lines.append('{0:10.4f}  {1:6d}  {2}'.format(total, count, name))
+    return '\n'.join(lines) + '\n'
+
+
+def probe_latency(host, port=PUPPET_MASTER_PORT,
+                  timeout=SERVER_PROBE_TIMEOUT):
+    """ Seconds it takes to connect to `host`, None if it is unreachable """
+    start = time.time()
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except socket.error:
+        return None
+    sock.close()
+    return time.time() - start
+
+
+def parse_ini(text):
+    """ [(section, [(key, value)])] of puppet.conf style `text`. Settings
+    before the first section are in the None section. """
+    ret = [(None, [])]
+    for line in text.splitlines():
+        m = INI_SECTION_RE.match(line)
+        if m:
+            ret.append((m.group(1), []))
+            continue
+        m = INI_SETTING_RE.match(line)
+        if m:
+            ret[-1][1].append((m.group(2), m.group(3)))
+    return [(section, settings) for section, settings in ret
+            if section or settings]
+
+
+def merge_ini(text, sections):
+    """ Sets the settings of `sections` (as returned by parse_ini()) in
+    puppet.conf style `text`. Other settings and comments are kept. """
+    wanted = collections.OrderedDict()
+    for section, settings in sections:
+        wanted.setdefault(section, collections.OrderedDict()).update(
+            settings)
+    done = set()
+    lines = []
+
+    def add_missing(section):
+        blank = []
+        while lines and not lines[-1].strip():
+            blank.append(lines.pop())
+        for key, value in wanted.get(section, {}).items():
+            if (section, key) not in done:
+                lines.append('    {0} = {1}'.format(key, value))
+                done.add((section, key))
+        lines.extend(blank)
+
+    section = None
+    for line in text.splitlines():
+        m = INI_SECTION_RE.match(line)
+        if m:
+            add_missing(section)
+            section = m.group(1)
+        else:
+            m = INI_SETTING_RE.match(line)
+            if m and m.group(2) in wanted.get(section, {}):
+                line = '{0}{1} = {2}'.format(
+                    m.group(1), m.group(2), wanted[section][m.group(2)])
+                done.add((section, m.group(2)))
+        lines.append(line)
+    add_missing(section)
+    for section, settings in wanted.items():
+        if any((section, key) not in done for key in settings):
+            lines += ['', '[{0}]'.format(section)]
+            add_missing(section)
+    return '\n'.join(lines) + '\n'
+
+
+def linux_distribution():
+    """ platform.linux_distribution(), detected once per process """
+    if 'distribution' not in _PROCESS_CACHE:
+        _PROCESS_CACHE['distribution'] = platform.linux_distribution()
+    return _PROCESS_CACHE['distribution']
+
+
+def normalize_module_name(name):
+    """ 'puppetlabs/apache' and 'puppetlabs-apache' are the same module """
+    return name.replace('/', '-')
+
+
+def parse_module_names(text):
+    """
+    Extracts module names from the output of `puppet module list` and
+    `puppet module install`. Both print a tree of modules where each
+    module name is followed by its version in parentheses.
+    """
+    ret = set()
+    prev = None
+    # Ugly output parsing :(
+    for cur in text.split():
+        if cur.startswith('(') and prev and PUPPET_MODULE_NAME_RE.match(prev):
+            ret.add(normalize_module_name(prev))
+        prev = cur
+    return ret
+
+
 class PuppetError(RuntimeError):
     """An exception for all Puppet related errors"""
 
@@ -75,26 +410,139 @@ class PuppetParamsError(PuppetError):
     """ Invalid parameters were supplied """
 
 
-def _context_to_struct(ctx):
-    return {
-        'node_id': ctx.node_id,
-        'node_name': ctx.node_name,
-        'blueprint_id': ctx.blueprint_id,
-        'deployment_id': ctx.deployment_id,
-        'properties': ctx.properties,
-        'runtime_properties': ctx.runtime_properties,
-        'capabilities': _try_extract_capabilities(ctx),
-        'host_ip': _try_extract_host_ip(ctx)
-    }
+def _facts_prefix_wanted(name, include, exclude):
+    """ Whether facts under the flattened `name` may pass the selection
+    of select_facts() """
+    if include and not any(p.startswith(name) or name.startswith(p)
+                           for p in include):
+        return False
+    return not (exclude and any(name.startswith(p) for p in exclude))
+
+
+def _lazy_struct(getters, prefix, include, exclude):
+    """ Calls only the getters of the keys which may pass the facts
+    selection. Some of the getters are REST calls to the manager. """
+    return dict((key, getter()) for key, getter in getters
+                if _facts_prefix_wanted(prefix + key, include, exclude))
+
+
+def _context_to_struct(ctx, include=None, exclude=None):
+    return _lazy_struct([
+        ('node_id', lambda: ctx.node_id),
+        ('node_name', lambda: ctx.node_name),
+        ('blueprint_id', lambda: ctx.blueprint_id),
+        ('deployment_id', lambda: ctx.deployment_id),
+        ('properties', lambda: ctx.properties),
+        ('runtime_properties', lambda: ctx.runtime_properties),
+        ('capabilities', lambda: _try_extract_capabilities(ctx)),
+        ('host_ip', lambda: _try_extract_host_ip(ctx)),
+    ], 'cloudify_', include, exclude)
+
+
+def _related_to_struct(related, include=None, exclude=None):
+    return _lazy_struct([
+        ('node_id', lambda: related.node_id),
+        ('properties', lambda: related.properties),
+        ('runtime_properties', lambda: related.runtime_properties),
+        ('host_ip', lambda: _try_extract_host_ip(related)),
+    ], 'cloudify_related_', include, exclude)
+
+
+def _fact_to_s(value):
+    """ Same as Ruby's to_s() of a JSON value, see cloudify_facts.rb """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return str(value)
+
+
+def flatten_facts(facts, prefix='', separator='_'):
+    """ {'a': {'b': 1}} -> {'a_b': '1'}, same as cloudify_facts.rb does
+    for the 'nested' facts format """
+    ret = {}
+    for key, value in facts.items():
+        if isinstance(value, dict):
+            ret.update(flatten_facts(value, prefix + key + separator,
+                                     separator))
+        else:
+            ret[prefix + key] = _fact_to_s(value)
+    return ret
+
+
+def format_external_facts(flat_facts):
+    """ Facter external facts .txt file contents (key=value lines) """
+    lines = []
+    for key, value in sorted(flat_facts.items()):
+        line = u'{0}={1}\n'.format(key, value.replace('\n', '\\n'))
+        lines.append(line.encode('utf-8'))
+    return ''.join(lines)
+
+
+def _fact_selected(name, include, exclude):
+    if include and not any(name.startswith(p) for p in include):
+        return False
+    return not (exclude and any(name.startswith(p) for p in exclude))
+
+
+def select_facts(facts, include=None, exclude=None, prefix=''):
+    """ Keeps the facts which, once flattened, start with one of the
+    `include` prefixes (all facts if None) and with none of the `exclude`
+    prefixes """
+    ret = {}
+    for key, value in facts.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            value = select_facts(value, include, exclude, name + '_')
+            if value:
+                ret[key] = value
+        elif _fact_selected(name, include, exclude):
+            ret[key] = value
+    return ret
+
+
+def _fact_leaves(facts, prefix=''):
+    """ Yields (flattened name, parent dict, key) of each non-map fact """
+    for key, value in facts.items():
+        if isinstance(value, dict):
+            for leaf in _fact_leaves(value, prefix + key + '_'):
+                yield leaf
+        else:
+            yield prefix + key, facts, key
 
 
-def _related_to_struct(related):
-    return {
-        'node_id': related.node_id,
-        'properties': related.properties,
-        'runtime_properties': related.runtime_properties,
-        'host_ip': _try_extract_host_ip(related)
-    }
+def bound_facts(facts, max_value_size=None, max_size=None):
+    """
+    Enforces size limits on facts, in place. Values which are longer than
+    `max_value_size` once converted to strings are truncated to it. Then,
+    while the total size of the flattened names and values exceeds
+    `max_size`, the largest facts are dropped.
+    Returns [(flattened name, original size)] of truncated or dropped facts
+    """
+    truncated = []
+    leaves = []
+    for name, parent, key in _fact_leaves(facts):
+        size = len(_fact_to_s(parent[key]))
+        if max_value_size is not None and size > max_value_size:
+            parent[key] = _fact_to_s(parent[key])[:max_value_size]
+            truncated.append((name, size))
+            size = max_value_size
+        leaves.append((size, name, parent, key))
+    if max_size is not None:
+        total = sum(size + len(name) for size, name, _, _ in leaves)
+        leaves.sort(key=lambda leaf: (-leaf[0], leaf[1]))
+        for size, name, parent, key in leaves:
+            if total <= max_size:
+                break
+            del parent[key]
+            total -= size + len(name)
+            if not any(n == name for n, _ in truncated):
+                truncated.append((name, size))
+    return truncated
 
 
 def _try_extract_capabilities(ctx):
@@ -111,62 +559,183 @@ def _try_extract_host_ip(ctx_or_related):
         return None
 
 
-class PuppetManager(object):
+def _terminate(proc, grace=10):
+    """ SIGTERM (which sudo relays to the command), then SIGKILL """
+    try:
+        proc.terminate()
+        for _ in range(grace * 10):
+            if proc.poll() is not None:
+                return
+            time.sleep(0.1)
+        proc.kill()
+    except OSError:
+        pass
 
-    # Copy+paste from Chef plugin - start
-    def _log_text(self, title, prefix, text):
-        ctx = self.ctx
-        if not text:
-            return
-        ctx.logger.info('*** ' + title + ' ***')
-        for line in text.splitlines():
-            ctx.logger.info(prefix + line)
 
-    def _sudo(self, *args):
-        """a helper to run a subprocess with sudo, raises SudoError"""
+def _popen_command(cmd, on_line, on_tick, timeout=None):
+    """ Runs `cmd`, calling on_line(stream, line) for each line of its
+    output, stream is 'out' or 'err', and on_tick() periodically. Kills
+    it after `timeout` seconds. Returns (exit code, whether it timed out).
+    The command is done when it exits, background processes which it
+    left running may keep its output open so the output is only read for
+    OUTPUT_DRAIN_TIMEOUT more seconds. Same interface as SudoHelper.run() """
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def read(name, pipe):
+        for line in iter(pipe.readline, b''):
+            with lock:
+                if done.is_set():
+                    break
+                on_line(name, line)
+        pipe.close()
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    readers = [
+        threading.Thread(target=read, args=('out', proc.stdout)),
+        threading.Thread(target=read, args=('err', proc.stderr)),
+    ]
+    waiter = threading.Thread(target=proc.wait)
+    for thread in readers + [waiter]:
+        thread.daemon = True
+        thread.start()
+
+    deadline = timeout and (time.time() + timeout)
+    timed_out = False
+    while waiter.is_alive():
+        waiter.join(OUTPUT_LOG_INTERVAL)
+        on_tick()
+        if deadline and not timed_out and time.time() > deadline:
+            timed_out = True
+            _terminate(proc)
+    drain_deadline = time.time() + OUTPUT_DRAIN_TIMEOUT
+    for reader in readers:
+        reader.join(max(0, drain_deadline - time.time()))
+    with lock:
+        done.set()
+    return proc.returncode, timed_out
+
+
+class OutputLogger(object):
+    """ Logs lines of commands output in batches, at most once in
+    `interval` seconds unless `max_lines` lines are pending """
+
+    def __init__(self, logger, interval=OUTPUT_LOG_INTERVAL,
+                 max_lines=OUTPUT_LOG_MAX_LINES):
+        self.logger = logger
+        self.interval = interval
+        self.max_lines = max_lines
+        self.lock = threading.Lock()
+        self.pending = []
+        self.last_flush = time.time()
+
+    def add(self, line):
+        with self.lock:
+            self.pending.append(line)
+            if len(self.pending) >= self.max_lines:
+                self._flush()
+
+    def flush_if_due(self):
+        with self.lock:
+            if time.time() - self.last_flush >= self.interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.logger.info('\n'.join(self.pending))
+            self.pending = []
+        self.last_flush = time.time()
 
-        ctx = self.ctx
 
-        def get_file_contents(f):
-            f.flush()
-            f.seek(0)
-            return f.read()
+class PuppetManager(object):
 
-        cmd = ["/usr/bin/sudo"] + list(args)
+    # Copy+paste from Chef plugin - start
+    def _sudo(self, *args, **kwargs):
+        """a helper to run a subprocess with sudo, raises SudoError.
+        See _run_command() for keyword arguments"""
+        helper = self._get_sudo_helper()
+        if helper:
+            return self._run_command(list(args), helper=helper, **kwargs)
+        return self._run_command(["/usr/bin/sudo"] + list(args), **kwargs)
+
+    def _run_command(self, cmd, capture=True, timeout=None, helper=None):
+        """
+        Runs `cmd`, logging its output as it arrives. Raises SudoError
+        with the tail of the output on failure or after `timeout` seconds.
+        Returns (stdout, stderr). With capture=False only the tails of
+        the output are kept and returned. With `helper`, a SudoHelper,
+        `cmd` is run by it.
+        """
+        ctx = self.ctx
         ctx.logger.info("Running: '%s'", ' '.join(cmd))
 
-        # TODO: Should we put the stdout/stderr in the celery logger?
-        #       should we also keep output of successful runs?
-        #       per log level? Also see comment under run_chef()
-        stdout = tempfile.TemporaryFile('rw+b')
-        stderr = tempfile.TemporaryFile('rw+b')
-        out = None
-        err = None
+        output_logger = OutputLogger(ctx.logger)
+        prefixes = {'out': '  [out] ', 'err': '  [err] '}
+        tails = {}
+        fulls = {}
+        for name in prefixes:
+            tails[name] = collections.deque(maxlen=SUDO_OUTPUT_TAIL_LINES)
+            fulls[name] = []
+
+        def on_line(name, line):
+            tails[name].append(line)
+            if capture:
+                fulls[name].append(line)
+            output_logger.add(prefixes[name] + line.rstrip('\n'))
+
+        run = helper.run if helper else _popen_command
         try:
-            subprocess.check_call(cmd, stdout=stdout, stderr=stderr)
-            out = get_file_contents(stdout)
-            err = get_file_contents(stderr)
-            self._log_text("stdout", "  [out] ", out)
-            self._log_text("stderr", "  [err] ", err)
-        except subprocess.CalledProcessError as exc:
+            returncode, timed_out = run(cmd, on_line,
+                                        output_logger.flush_if_due, timeout)
+        except SudoHelperError as exc:
+            raise SudoError("Command '{0}' failed: {1}".format(cmd, exc))
+        output_logger.flush()
+
+        out_tail = ''.join(tails['out'])
+        err_tail = ''.join(tails['err'])
+        if timed_out:
+            raise SudoError("Command '{cmd}' timed out after {timeout} "
+                            "seconds\nSTDOUT:\n{stdout}\nSTDERR:{stderr}".
+                            format(cmd=cmd, timeout=timeout,
+                                   stdout=out_tail, stderr=err_tail))
+        if returncode:
+            exc = subprocess.CalledProcessError(returncode, cmd)
             raise SudoError("{exc}\nSTDOUT:\n{stdout}\nSTDERR:{stderr}".format(
                 exc=exc,
-                stdout=get_file_contents(stdout),
-                stderr=get_file_contents(stderr)))
-        finally:
-            stdout.close()
-            stderr.close()
+                stdout=out_tail,
+                stderr=err_tail))
 
-        return out, err
+        if capture:
+            return ''.join(fulls['out']), ''.join(fulls['err'])
+        return out_tail, err_tail
 
     def _sudo_write_file(self, filename, contents):
         """a helper to create a file with sudo"""
+        helper = self._get_sudo_helper()
+        if helper:
+            try:
+                helper.write_file(filename, contents)
+            except SudoHelperError as exc:
+                raise SudoError(str(exc))
+            return
+
         with tempfile.NamedTemporaryFile(delete=False) as temp_file:
             temp_file.write(contents)
 
         self._sudo("mv", temp_file.name, filename)
 
     def _prog_available_for_root(self, prog):
+        if self._get_sudo_helper():
+            try:
+                self._sudo("which", prog)
+            except SudoError:
+                return False
+            return True
         with open(os.devnull, "w") as fnull:
             which_exitcode = subprocess.call(
                 ["/usr/bin/sudo", "which", prog], stdout=fnull, stderr=fnull)
@@ -182,7 +751,11 @@ class PuppetManager(object):
         if cls is PuppetManager:
             r = PuppetRunner.get_runner_class(ctx)
             i = PuppetInstaller.get_installer_class()
-            cls = type(r.__name__ + i.__name__, (r, i, PuppetManager), {})
+            key = ('class', r, i)
+            if key not in _PROCESS_CACHE:
+                _PROCESS_CACHE[key] = type(r.__name__ + i.__name__,
+                                           (r, i, PuppetManager), {})
+            cls = _PROCESS_CACHE[key]
             ctx.logger.debug("PuppetManager class: {0}".format(cls))
         # Disable magic for subclasses
         return super(PuppetManager, cls).__new__(cls, ctx)
@@ -191,44 +764,226 @@ class PuppetManager(object):
         self.ctx = ctx
         self.props = self.ctx.properties['puppet_config']
         self.environment = None
+        self._sudo_helper = None
+        self._sudo_helper_lock = threading.Lock()
         self.process_properties()
 
+    def _get_sudo_helper(self):
+        """ The privileged helper of this operation, started on first use.
+        None unless puppet_config.sudo_helper """
+        if not self.props.get('sudo_helper'):
+            return None
+        with self._sudo_helper_lock:
+            if self._sudo_helper is None:
+                self.ctx.logger.info("Starting the sudo helper")
+                self._sudo_helper = SudoHelper()
+        return self._sudo_helper
+
+    def _sudo_popen(self, cmd):
+        """ Starts `cmd` with sudo for writing to its standard input.
+        Returns an object with `stdin` and wait(), like subprocess.Popen """
+        helper = self._get_sudo_helper()
+        if helper:
+            def on_line(name, line):
+                self.ctx.logger.info('  [{0}] {1}'.format(
+                    name, line.rstrip('\n')))
+            return helper.popen(cmd, on_line)
+        return subprocess.Popen(['sudo'] + cmd, stdin=subprocess.PIPE)
+
+    def close(self):
+        """ Stops the sudo helper, if it was started """
+        with self._sudo_helper_lock:
+            helper, self._sudo_helper = self._sudo_helper, None
+        if helper:
+            helper.close()
+
     def puppet_is_installed(self):
-        return self._prog_available_for_root('puppet')
+        """ The result is cached per process and, with
+        puppet_config.cache_install_state, on disk """
+        if 'puppet_installed' not in _PROCESS_CACHE:
+            if (self.props.get('cache_install_state') and
+                    os.path.exists(INSTALL_STATE_FILE)):
+                _PROCESS_CACHE['puppet_installed'] = True
+            else:
+                self.set_puppet_installed(
+                    self._prog_available_for_root('puppet'))
+        return _PROCESS_CACHE['puppet_installed']
+
+    def set_puppet_installed(self, installed):
+        _PROCESS_CACHE['puppet_installed'] = installed
+        if not self.props.get('cache_install_state'):
+            return
+        if installed:
+            if not os.path.isdir(os.path.dirname(INSTALL_STATE_FILE)):
+                os.makedirs(os.path.dirname(INSTALL_STATE_FILE))
+            open(INSTALL_STATE_FILE, 'w').close()
+        elif os.path.exists(INSTALL_STATE_FILE):
+            os.remove(INSTALL_STATE_FILE)
+
+    def get_image_manifest(self):
+        """
+        The manifest of a pre-baked image, if the image matches this
+        configuration. The manifest is a JSON file with:
+        puppet_version - the installed Puppet package version,
+        modules - the installed Puppet modules,
+        facts_plugin_sha256 - digest of the installed cloudify_facts.rb.
+        """
+        if 'image_manifest' not in _PROCESS_CACHE:
+            manifest = None
+            try:
+                with open(self.props.get('image_manifest',
+                                         IMAGE_MANIFEST_FILE)) as f:
+                    manifest = json.load(f)
+                with open(CUSTOM_FACTS_FILE, 'rb') as f:
+                    facts_digest = hashlib.sha256(f.read()).hexdigest()
+            except (IOError, ValueError):
+                manifest = None
+            if manifest and (manifest.get('facts_plugin_sha256') !=
+                             facts_digest):
+                self.ctx.logger.info("Pre-baked image has another version "
+                                     "of cloudify_facts.rb, ignoring it")
+                manifest = None
+            _PROCESS_CACHE['image_manifest'] = manifest
+        manifest = _PROCESS_CACHE['image_manifest']
+        version = self.props.get('version')
+        if manifest and version and manifest.get('puppet_version') != version:
+            self.ctx.logger.info("Pre-baked image has Puppet {0}, not {1}, "
+                                 "ignoring it".format(
+                                     manifest.get('puppet_version'), version))
+            return None
+        return manifest
 
     def install(self):
+        if self.get_image_manifest():
+            # Only the configuration is specific to the node instance, so
+            # it runs for every node instance sharing this process
+            if not _PROCESS_CACHE.get('puppet_installed'):
+                self.ctx.logger.info("Using pre-baked image, not "
+                                     "installing Puppet")
+                self.set_puppet_installed(True)
+            self.configure()
+            return
         if self.puppet_is_installed():
             self.ctx.logger.info("Not installing Puppet as "
                                  "it's already installed")
             return
-        url = self.get_repo_package_url()
-        response = requests.head(url)
-        if response.status_code != requests.codes.ok:
-            raise PuppetError("Repo package is not available (at {0})".format(
-                url))
-
-        self.ctx.logger.info("Installing package from {0}".format(url))
-        self.install_package_from_url(url)
-        self.refresh_packages_cache()
-        for p in 'puppet-common', 'puppet':
-            self.install_package(p,
-                                 self.props.get('version',
-                                                self.DEFAULT_VERSION))
-        for package_name in self.EXTRA_PACKAGES:
-            self.install_package(package_name)
+        if self.props.get('packages_bundle'):
+            self.install_packages_bundle(self.props['packages_bundle'])
+        else:
+            self.install_packages_from_repo()
 
         self._sudo("mkdir", "-p", *self.DIRS.values())
         self._sudo("chmod", "700", *self.DIRS.values())
         self.install_custom_facts()
         self.configure()
+        self.set_puppet_installed(True)
+
+    def install_packages_from_repo(self):
+        mirror = self.props.get('packages_mirror')
+        if mirror:
+            key = self.props.get('packages_mirror_key')
+            if not key and not self.props.get('packages_mirror_unsigned'):
+                raise PuppetParamsError(
+                    "puppet_config.packages_mirror requires either "
+                    "packages_mirror_key or packages_mirror_unsigned: true")
+            self.ctx.logger.info("Using packages mirror {0}".format(mirror))
+            if key:
+                with tempfile.NamedTemporaryFile() as f:
+                    self._download_to_file(key, f)
+                    self.add_packages_mirror_key(f.name)
+            self.add_packages_mirror(mirror, signed=bool(key))
+        else:
+            url = self.get_repo_package_url()
+            response = requests.head(url)
+            if response.status_code != requests.codes.ok:
+                raise PuppetError(
+                    "Repo package is not available (at {0})".format(url))
+
+            self.ctx.logger.info("Installing package from {0}".format(url))
+            self.install_package_from_url(url)
+        max_age = self.props.get('packages_cache_max_age')
+        if max_age is not None and self.packages_cache_is_fresh(
+                float(max_age)):
+            self.ctx.logger.info("Packages cache is up to date, not "
+                                 "refreshing it")
+        else:
+            self.refresh_packages_cache()
+        version = self.props.get('version', self.DEFAULT_VERSION)
+        self.install_packages(
+            [(p, version) for p in self.PUPPET_PACKAGES] +
+            [(p, None) for p in self.get_extra_packages()])
+
+    def install_packages_bundle(self, url):
+        """ Installs all the packages of the .tar.gz at `url` in one
+        transaction, without using any repository """
+        cache = DownloadCache.from_props(self.ctx.logger, self.props)
+        archive, _ = self._fetch_archive(cache, url)
+        tmp_dir = tempfile.mkdtemp(prefix='puppet.packages.')
+        try:
+            with tarfile.open(archive) as tar:
+                unsafe = unsafe_tar_members(tar)
+                if unsafe:
+                    raise PuppetError(
+                        "Refusing to extract {0}, it has unsafe "
+                        "members: {1}".format(url, ', '.join(unsafe)))
+                tar.extractall(tmp_dir)
+            packages = []
+            for root, _, files in os.walk(tmp_dir):
+                packages += [os.path.join(root, name) for name in files
+                             if name.endswith(self.PACKAGE_FILE_SUFFIX)]
+            if not packages:
+                raise PuppetError("No {0} packages in {1}".format(
+                    self.PACKAGE_FILE_SUFFIX, url))
+            self.ctx.logger.info("Installing {0} packages from {1}".format(
+                len(packages), url))
+            self.install_package_files(sorted(packages))
+        finally:
+            shutil.rmtree(tmp_dir)
+        cache.evict()
+
+    def _download_to_file(self, url, f):
+        """ Writes resource or URL `url` to the file object `f` """
+        is_resource, path = is_resource_url(url)
+        try:
+            if is_resource:
+                self.ctx.download_resource(path, f.name)
+            else:
+                response, _ = stream_download(url, f)
+                f.flush()
+                if response.status_code != requests.codes.ok:
+                    raise DownloadError("HTTP status {0}".format(
+                        response.status_code))
+        except (DownloadError, requests.RequestException) as exc:
+            raise PuppetError("Failed to download {0}: {1}".format(url, exc))
+
+    def _fetch_archive(self, cache, url):
+        """
+        Gets .tar.gz from `url` into the download cache.
+        If URL is relative ("/xyz.tar.gz"), it's fetched using
+        download_resource().
+        Returns (path, digest)
+        """
+        ctx = self.ctx
+        is_resource, path = is_resource_url(url)
+        try:
+            if is_resource:
+                ctx.logger.info("Getting resource {0}".format(path))
+                return cache.fetch_resource(ctx, path)
+            ctx.logger.info("Downloading from {0}".format(url))
+            return cache.fetch_url(url)
+        except (DownloadError, requests.RequestException) as exc:
+            raise PuppetError("Failed to download {0}: {1}".format(url, exc))
 
     def refresh_packages_cache(self):
         pass
 
+    def packages_cache_is_fresh(self, max_age):
+        """ Whether the packages cache was refreshed in the last `max_age`
+        seconds, after the last change of the repositories """
+        return False
+
     def install_custom_facts(self):
-        facts_source_path = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            'puppet', 'facts', 'cloudify_facts.rb')
+        facts_source_path = CUSTOM_FACTS_FILE
         facts_destination_path = self.DIRS['local_custom_facts']
         self.ctx.logger.info("Installing custom facts {0} to {1}".format(
             facts_source_path,
@@ -242,8 +997,17 @@ class PuppetManager(object):
 class RubyGemJsonExtraPackageMixin(object):
     EXTRA_PACKAGES = ["rubygem-json"]
 
+    def get_extra_packages(self):
+        # Only the Ruby custom facts loader and the run report summary
+        # need JSON
+        if (self.props.get('facts_format') == 'external' and
+                not self.props.get('run_report')):
+            return [p for p in self.EXTRA_PACKAGES if p != 'rubygem-json']
+        return self.EXTRA_PACKAGES
+
 
 class PuppetInstaller(object):
+    PUPPET_PACKAGES = ('puppet-common', 'puppet')
     EXTRA_PACKAGES = []
     DEFAULT_VERSION = '3.5.1-1puppetlabs1'
     DIRS = {
@@ -254,83 +1018,209 @@ class PuppetInstaller(object):
 
     @classmethod
     def get_installer_class(cls):
+        if 'installer_class' in _PROCESS_CACHE:
+            return _PROCESS_CACHE['installer_class']
         classes = cls.__subclasses__()
         classes = [c for c in classes if c._installer_handles()]
         if len(classes) != 1:
             raise PuppetInternalLogicError(
                 "Failed to find correct PuppetInstaller")
+        _PROCESS_CACHE['installer_class'] = classes[0]
         return classes[0]
 
+    def get_extra_packages(self):
+        return self.EXTRA_PACKAGES
+
+    def install_package_from_url(self, url):
+
+        name = os.path.basename(urlparse.urlparse(url).path)
+
+        pkg_file = tempfile.NamedTemporaryFile(suffix='.'+name, delete=False)
+        self.ctx.logger.info("Using temp file {0} for package installation".
+                             format(pkg_file.name))
+        try:
+            response, _ = stream_download(
+                url, pkg_file,
+                chunk_size=self.props.get('download_chunk_size'),
+                retries=self.props.get('download_retries'),
+                expected_digest=self.props.get(
+                    'download_checksums', {}).get(url))
+        except (DownloadError, requests.RequestException) as exc:
+            raise PuppetError("Failed to download {0}: {1}".format(url, exc))
+        finally:
+            pkg_file.close()
+        if response.status_code != requests.codes.ok:
+            raise PuppetError("Failed to download {0}: HTTP {1}".format(
+                url, response.status_code))
+        self.install_package_files([pkg_file.name])
+        os.remove(pkg_file.name)
+
 
 class PuppetDebianInstaller(PuppetInstaller):
 
     @staticmethod
     def _installer_handles():
-        return platform.linux_distribution()[0].lower() in (
+        return linux_distribution()[0].lower() in (
             'debian', 'ubuntu', 'mint')
 
-    def get_repo_package_url(self):
-        ver = platform.linux_distribution()
+    PACKAGE_FILE_SUFFIX = '.deb'
+    MIRROR_SOURCES_LIST = '/etc/apt/sources.list.d/puppetlabs-mirror.list'
+
+    @staticmethod
+    def _get_codename():
+        ver = linux_distribution()
         if ver[2]:
-            ver = ver[2]
-        else:
-            if ver[1].endswith('/sid'):
-                ver = 'sid'
-            else:
-                raise PuppetError("Fail to detect Linux distro version")
+            return ver[2]
+        if ver[1].endswith('/sid'):
+            return 'sid'
+        raise PuppetError("Fail to detect Linux distro version")
 
+    def get_repo_package_url(self):
+        ver = self._get_codename()
         url = self.props.get('repos', {}).get('deb', {}).get(ver)
         return (
             url
             or
             'http://apt.puppetlabs.com/puppetlabs-release-{0}.deb'.format(ver))
 
-    def install_package_from_url(self, url):
+    def add_packages_mirror_key(self, path):
+        self._sudo('apt-key', 'add', path)
 
-        name = os.path.basename(urlparse.urlparse(url).path)
-
-        pkg_file = tempfile.NamedTemporaryFile(suffix='.'+name, delete=False)
-        self.ctx.logger.info("Using temp file {0} for package installation".
-                             format(pkg_file.name))
-        pkg_file.write(requests.get(url).content)
-        pkg_file.flush()
-        pkg_file.close()
-        self._sudo('dpkg', '-i', pkg_file.name)
-        os.remove(pkg_file.name)
+    def add_packages_mirror(self, url, signed=True):
+        # The puppetlabs-release package, which adds the Puppet Labs key,
+        # is not installed. Unsigned mirrors must be trusted explicitly.
+        self._sudo_write_file(
+            self.MIRROR_SOURCES_LIST,
+            'deb {0}{1} {2} main dependencies\n'.format(
+                '' if signed else '[trusted=yes] ', url,
+                self._get_codename()))
+        self._sudo('chmod', '644', self.MIRROR_SOURCES_LIST)
 
     def refresh_packages_cache(self):
+        if self.props.get('packages_mirror'):
+            # Only the mirror is needed
+            self._sudo('apt-get', 'update',
+                       '-o', 'Dir::Etc::sourcelist=' +
+                       self.MIRROR_SOURCES_LIST,
+                       '-o', 'Dir::Etc::sourceparts=-',
+                       '-o', 'APT::Get::List-Cleanup=0')
+            return
         self._sudo('apt-get', 'update')
 
-    # XXX: package_version is not sanitized
-    def install_package(self, package_name, package_version=None):
-        if package_version is None:
-            p = package_name
-        else:
-            p = package_name + '=' + str(package_version)
-        self._sudo('apt-get', 'install', '-y', p)
+    def install_package_files(self, paths):
+        self._sudo('dpkg', '-i', *paths)
+
+    def packages_cache_is_fresh(self, max_age):
+        try:
+            refreshed = os.path.getmtime(APT_LISTS_DIR)
+            sources = [APT_SOURCES_LIST] + [
+                os.path.join(APT_SOURCES_PARTS, name)
+                for name in os.listdir(APT_SOURCES_PARTS)]
+        except OSError:
+            return False
+        if time.time() - refreshed > max_age:
+            return False
+        # ctime, as dpkg keeps the mtime of the files it installs
+        changed = [os.stat(path).st_ctime for path in sources
+                   if os.path.exists(path)]
+        if not changed:
+            # No repositories at all, let apt-get update tell
+            return False
+        return max(changed) <= refreshed
+
+    # XXX: versions are not sanitized
+    def install_packages(self, packages):
+        """ Installs [(name, version or None)] in one transaction """
+        self._sudo('apt-get', 'install', '-y', *[
+            name if version is None else name + '=' + str(version)
+            for name, version in packages])
 
 
 class PuppetRHELInstaller(RubyGemJsonExtraPackageMixin, PuppetInstaller):
-    """ UNTESTED """
+    """ RHEL, CentOS, Scientific Linux, Oracle Linux and Fedora """
 
-    @staticmethod
-    def _installer_handles():
-        return platform.linux_distribution()[0] in (
-            'redhat', 'centos', 'fedora')
+    PUPPET_PACKAGES = ('puppet',)
+    # Matches the packages of all EL versions, e.g. 3.5.1-1.el6
+    DEFAULT_VERSION = '3.5.1'
+    DISTRIBUTIONS = ('red hat', 'redhat', 'centos', 'scientific', 'oracle',
+                     'fedora')
 
-    def get_repo_package_url(self):
-        raise NotImplementedError()
+    @classmethod
+    def _installer_handles(cls):
+        name = linux_distribution()[0].lower()
+        return any(name.startswith(d) for d in cls.DISTRIBUTIONS)
 
-    def install_package_from_url(self, url):
-        self._sudo("rpm", "-ivh", url)
+    PACKAGE_FILE_SUFFIX = '.rpm'
+    MIRROR_REPO_FILE = '/etc/yum.repos.d/puppetlabs-mirror.repo'
+    MIRROR_KEY_FILE = '/etc/pki/rpm-gpg/RPM-GPG-KEY-puppetlabs-mirror'
+
+    @staticmethod
+    def _get_release():
+        """ ('el', major version) or ('fedora', version) """
+        name, ver, _ = linux_distribution()
+        major = ver.split('.')[0]
+        if not major.isdigit():
+            raise PuppetError("Fail to detect Linux distro version")
+        if name.lower().startswith('fedora'):
+            return 'fedora', major
+        return 'el', major
 
-    # XXX: package_version is not sanitized
-    def install_package(self, package_name, package_version=None):
-        if package_version is None:
-            p = package_name
+    def get_repo_package_url(self):
+        family, ver = self._get_release()
+        repos = self.props.get('repos', {}).get('rpm', {})
+        # YAML keys like 6 are integers
+        url = repos.get(ver) or repos.get(int(ver))
+        return (
+            url
+            or
+            'http://yum.puppetlabs.com/puppetlabs-release-{0}-{1}.noarch.rpm'.
+            format(family, ver))
+
+    def get_package_manager(self):
+        if 'rpm_package_manager' not in _PROCESS_CACHE:
+            _PROCESS_CACHE['rpm_package_manager'] = (
+                'dnf' if os.path.exists('/usr/bin/dnf') else 'yum')
+        return _PROCESS_CACHE['rpm_package_manager']
+
+    def add_packages_mirror_key(self, path):
+        self._sudo('install', '-D', '-m', '644', path, self.MIRROR_KEY_FILE)
+
+    def add_packages_mirror(self, url, signed=True):
+        if signed:
+            gpg = 'gpgcheck=1\ngpgkey=file://{0}\n'.format(
+                self.MIRROR_KEY_FILE)
         else:
-            p = package_name + '-' + str(package_version)
-        self._sudo('yum', 'install', '-y', p)
+            gpg = 'gpgcheck=0\n'
+        self._sudo_write_file(
+            self.MIRROR_REPO_FILE,
+            '[puppetlabs-mirror]\n'
+            'name=Puppet Labs mirror\n'
+            'baseurl={0}\n'
+            'enabled=1\n'.format(url) + gpg)
+        self._sudo('chmod', '644', self.MIRROR_REPO_FILE)
+
+    def _metadata_expire_opts(self):
+        max_age = self.props.get('packages_cache_max_age')
+        if max_age is None:
+            return []
+        return ['--setopt=metadata_expire={0}'.format(int(max_age))]
+
+    def refresh_packages_cache(self):
+        # Only the metadata which expired is downloaded. Repositories
+        # which were just added have no metadata yet.
+        self._sudo(self.get_package_manager(), 'makecache',
+                   *self._metadata_expire_opts())
+
+    def install_package_files(self, paths):
+        self._sudo('rpm', '-Uvh', '--replacepkgs', *paths)
+
+    # XXX: versions are not sanitized
+    def install_packages(self, packages):
+        """ Installs [(name, version or None)] in one transaction """
+        self._sudo(self.get_package_manager(), 'install', '-y', *(
+            self._metadata_expire_opts() + [
+                name if version is None else name + '-' + str(version)
+                for name, version in packages]))
 
 # *** Runner ***
 
@@ -367,15 +1257,13 @@ class PuppetRunner(object):
         facts = self.props.get('facts', {})
         if 'cloudify' in facts:
             raise PuppetError("Puppet attributes must not contain 'cloudify'")
-        facts['cloudify'] = _context_to_struct(ctx)
+        facts_include = self.props.get('facts_include')
+        facts_exclude = self.props.get('facts_exclude')
+        facts['cloudify'] = _context_to_struct(ctx, facts_include,
+                                               facts_exclude)
         if ctx.related:
-            facts['cloudify']['related'] = _related_to_struct(ctx.related)
-        t = 'puppet.{0}.{1}.{2}.'.format(
-            ctx.node_name, ctx.node_id, os.getpid())
-        temp_file = tempfile.NamedTemporaryFile
-        facts_file = temp_file(prefix=t, suffix=".facts_in.json", delete=False)
-        json.dump(facts, facts_file, indent=4)
-        facts_file.close()
+            facts['cloudify']['related'] = _related_to_struct(
+                ctx.related, facts_include, facts_exclude)
 
         cmd = [
             "puppet",
@@ -388,32 +1276,235 @@ class PuppetRunner(object):
         if tags:
             cmd += ['--tags', ','.join(tags)]
 
+        profile = self.props.get('profile')
+        if profile:
+            cmd += ['--profile', '--evaltrace']
+
         cmd = ' '.join(cmd)
 
-        environ = self.get_run_env_vars()
+        env_vars = self.get_run_env_vars()
+        facts_format = self.props.get('facts_format', 'nested')
+        if facts_format not in FACTS_FORMATS:
+            raise PuppetParamsError(
+                "puppet_config.facts_format must be one of {0}, you gave "
+                "'{1}'".format(', '.join(FACTS_FORMATS), facts_format))
+        env_vars['CLOUDIFY_FACTS_FORMAT'] = facts_format
+
+        fingerprint = None
+        if self.props.get('run_fingerprint'):
+            fingerprint = self.get_run_fingerprint(cmd, facts, env_vars)
+            if self._is_unchanged_run(fingerprint):
+                ctx.logger.info("Inputs did not change since the last "
+                                "successful run ({0}), not running "
+                                "Puppet".format(fingerprint))
+                return
+
+        t = 'puppet.{0}.{1}.{2}.'.format(
+            ctx.node_name, ctx.node_id, os.getpid())
+        temp_file = tempfile.NamedTemporaryFile
+        facts_out = select_facts(facts, facts_include, facts_exclude)
+        truncated = bound_facts(facts_out,
+                                self.props.get('facts_max_value_size'),
+                                self.props.get('facts_max_size'))
+        if truncated:
+            ctx.logger.warning(
+                "Facts exceeding the size limits were truncated or "
+                "dropped: {0}".format(', '.join(
+                    '{0} ({1} characters)'.format(*t) for t in truncated)))
+            facts_out.setdefault('cloudify', {})['truncated_facts'] = [
+                name for name, _ in truncated]
+        if facts_format == 'external':
+            facts_file = temp_file(prefix=t, suffix=".facts_in.txt",
+                                   delete=False)
+            facts_file.write(format_external_facts(flatten_facts(facts_out)))
+        else:
+            facts_file = temp_file(prefix=t, suffix=".facts_in.json",
+                                   delete=False)
+            if facts_format == 'flat':
+                facts_out = flatten_facts(facts_out)
+            json.dump(facts_out, facts_file, separators=(',', ':'))
+        facts_file.close()
+
         environ = ["export {0}='{1}'\n".format(k, v)
-                   for k, v in environ.items()]
+                   for k, v in env_vars.items()]
         environ = ''.join(environ)
         run_file = temp_file(prefix=t, suffix=".run.sh", delete=False)
-        run_file.write(
+        run_file.write(self.get_run_script(cmd, facts_file.name, environ,
+                                           tags))
+        run_file.close()
+        self._sudo('chmod', '+x', run_file.name)
+        self.ctx.logger.info("Will run: '{0}' (in {1})".format(cmd,
+                                                               run_file.name))
+        started = time.time()
+        try:
+            out, _ = self.run_script(run_file.name, capture=bool(profile))
+        except SudoError as exc:
+            if self.props.get('run_report'):
+                self.publish_run_report(str(exc), started)
+            raise
+
+        os.remove(facts_file.name)
+        if self.props.get('run_report'):
+            self.publish_run_report(out, started)
+        if profile:
+            self.publish_profile(
+                out, facts_file.name.rsplit('.facts_in.', 1)[0] +
+                '.profile.txt')
+        if fingerprint:
+            self._record_run(fingerprint)
+
+    def run_script(self, run_file_name, capture, *args):
+        """ Runs the script generated by get_run_script() """
+        return self._sudo(run_file_name, *args, capture=capture,
+                          timeout=self.props.get('run_timeout'))
+
+    def publish_profile(self, output, profile_file_name):
+        """ Logs the hot spots table of a profiled run and saves it
+        to `profile_file_name` """
+        conf = self.props['profile']
+        if not isinstance(conf, dict):
+            conf = {}
+        table = format_profile_table(parse_profile(output),
+                                     conf.get('top', DEFAULT_PROFILE_TOP))
+        with open(profile_file_name, 'w') as f:
+            f.write(table)
+        self.ctx.logger.info("Puppet profile (saved to {0}):\n{1}".format(
+            profile_file_name, table))
+
+    def get_run_script(self, cmd, facts_file_name, environ, tags):
+        """ Contents of the script which runs `cmd` """
+        return (
             '#!/bin/bash -e\n'
-            'export FACTERLIB={0}\n'
-            'export CLOUDIFY_FACTS_FILE={1}\n{2}'
+            'cleanup=\n'
+            '{0}{1}'
             'e=0\n'
-            .format(self.DIRS['local_custom_facts'], facts_file.name, environ)
+            .format(self.get_facts_setup(facts_file_name), environ)
             + cmd + ' || e=$?\n'
             'echo Exit code: $e\n'
             'if [ $e -eq 1 ];then exit 1;fi\n'
             'if [ $(($e & 4)) -eq 4 ];then exit 4;fi\n'
             'exit 0\n'
         )
-        run_file.close()
-        self._sudo('chmod', '+x', run_file.name)
-        self.ctx.logger.info("Will run: '{0}' (in {1})".format(cmd,
-                                                               run_file.name))
-        self._sudo(run_file.name)
 
-        os.remove(facts_file.name)
+    def get_facts_setup(self, facts_file_name,
+                        custom_facts_file_name=None):
+        """ Shell commands which make the facts file available to Facter.
+        The custom facts loader reads `custom_facts_file_name`, which
+        defaults to the facts file itself """
+        if self.props.get('facts_format') == 'external':
+            facts_dir = self.props.get('external_facts_dir',
+                                       DEFAULT_EXTERNAL_FACTS_DIR)
+            return EXTERNAL_FACTS_SETUP_TPL.format(
+                lock=EXTERNAL_FACTS_LOCK,
+                facts_dir=facts_dir,
+                dst=os.path.join(facts_dir, 'cloudify.txt'),
+                facts_file=facts_file_name)
+        setup = ''
+        if custom_facts_file_name:
+            setup = 'cp {0} {1}\n'.format(facts_file_name,
+                                          custom_facts_file_name)
+        return setup + (
+            'export FACTERLIB={0}\n'
+            'export CLOUDIFY_FACTS_FILE={1}\n'
+            .format(self.DIRS['local_custom_facts'],
+                    custom_facts_file_name or facts_file_name))
+
+    def publish_run_report(self, output, started=None):
+        """ Puts a summary of the last Puppet run report into the
+        puppet_last_run runtime property. `output` is the output of the
+        run script, which started at `started` (epoch seconds). A report
+        older than that is left out and the summary has 'report_stale' """
+        ctx = self.ctx
+        conf = self.props['run_report']
+        if not isinstance(conf, dict):
+            conf = {}
+        summary = {'operation': ctx.operation}
+        exit_codes = re.findall(r'^Exit code: (\d+)$', output, re.MULTILINE)
+        if exit_codes:
+            summary['exit_code'] = int(exit_codes[-1])
+        try:
+            out, _ = self._sudo('ruby', REPORT_SUMMARY_SCRIPT,
+                                PUPPET_LAST_RUN_REPORT,
+                                str(conf.get('top', DEFAULT_REPORT_TOP)))
+            report = json.loads(out.strip().splitlines()[-1])
+        except (SudoError, ValueError, IndexError) as exc:
+            ctx.logger.warn("Failed to read Puppet run report: {0}".format(
+                exc))
+        else:
+            report_time = report.pop('report_time', None)
+            if started and (report_time or 0) < started:
+                # The run failed or timed out before Puppet wrote a report
+                ctx.logger.warn("Puppet run report {0} is from a previous "
+                                "run, not publishing it".format(
+                                    PUPPET_LAST_RUN_REPORT))
+                summary['report_stale'] = True
+            else:
+                summary.update(report)
+        ctx.runtime_properties['puppet_last_run'] = summary
+        ctx.logger.info("Puppet run summary: {0}".format(
+            json.dumps(summary, sort_keys=True)))
+
+    def get_fingerprint_paths(self):
+        """ Directories which affect the result of a Puppet run """
+        return self.get_modules_path().split(':')
+
+    def _paths_fingerprint(self, paths):
+        """ Hash of the contents of all files under `paths`.
+        Runs with sudo as some of the directories are only readable by
+        root. Missing paths are ignored. """
+        script = ('find "$@" -type f -print0 2>/dev/null | sort -z | '
+                  'xargs -0 -r sha256sum | sha256sum')
+        out, _ = self._sudo('sh', '-c', script, 'sh', *paths)
+        return out.split()[0]
+
+    def get_run_fingerprint(self, cmd, facts, env_vars):
+        """ Hash of everything that feeds a Puppet run """
+        facts = copy.deepcopy(facts)
+        runtime_properties = facts['cloudify'].get('runtime_properties', {})
+        for key in PLUGIN_RUNTIME_PROPERTIES:
+            runtime_properties.pop(key, None)
+        inputs = {
+            'cmd': cmd,
+            'facts': facts,
+            'env': env_vars,
+            'files': self._paths_fingerprint(self.get_fingerprint_paths()),
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def _run_state_path(self):
+        return os.path.join(RUN_STATE_DIR, self.ctx.node_id + '.json')
+
+    def _load_run_state(self):
+        try:
+            with open(self._run_state_path()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _is_unchanged_run(self, fingerprint):
+        conf = self.props['run_fingerprint']
+        if not isinstance(conf, dict):
+            conf = {}
+        if conf.get('force'):
+            return False
+        last = self._load_run_state().get(self.ctx.operation)
+        if not last or last['fingerprint'] != fingerprint:
+            return False
+        ttl = conf.get('ttl', DEFAULT_RUN_FINGERPRINT_TTL)
+        return time.time() - last['time'] < ttl
+
+    def _record_run(self, fingerprint):
+        state = self._load_run_state()
+        state[self.ctx.operation] = {
+            'fingerprint': fingerprint,
+            'time': time.time(),
+        }
+        if not os.path.isdir(RUN_STATE_DIR):
+            os.makedirs(RUN_STATE_DIR)
+        with tempfile.NamedTemporaryFile(dir=RUN_STATE_DIR,
+                                         delete=False) as f:
+            json.dump(state, f)
+        os.rename(f.name, self._run_state_path())
 
     def get_modules_path(self):
         local_modules_path = os.path.join(self.DIRS['local_repo'], 'modules')
@@ -428,35 +1519,262 @@ class PuppetAgentRunner(PuppetRunner):
         if 'environment' not in p:
             raise PuppetParamsError("puppet_config.environment is missing")
         self.set_environment(p['environment'])
+        servers = p['server']
+        if isinstance(servers, basestring):
+            servers = [servers]
+        if not (isinstance(servers, list) and servers):
+            raise PuppetParamsError("puppet_config.server must be a host "
+                                    "name or a list of host names")
+        policy = p.get('server_policy', 'hash')
+        if policy not in SERVER_POLICIES:
+            raise PuppetParamsError(
+                "puppet_config.server_policy must be one of {0}, you gave "
+                "'{1}'".format(', '.join(SERVER_POLICIES), policy))
+        if p.get('ssl_preseed') and not p.get('stable_certname'):
+            raise PuppetParamsError(
+                "puppet_config.ssl_preseed requires stable_certname: true, "
+                "the certificate must match the certname of the node")
+        self.servers = servers
+        self.server_policy = policy
+        self._ordered_servers = None
+
+    def get_servers(self):
+        """ The masters, in the order they should be tried """
+        if self._ordered_servers is None:
+            self._ordered_servers = self._order_servers()
+        return self._ordered_servers
+
+    def _order_servers(self):
+        servers = self.servers
+        if len(servers) < 2 or self.server_policy == 'ordered':
+            return servers
+        if self.server_policy == 'hash':
+            # Same node instance, same master
+            first = int(hashlib.sha1(self.ctx.node_id).hexdigest(), 16)
+            first %= len(servers)
+            return servers[first:] + servers[:first]
+        pool = ThreadPool(len(servers))
+        try:
+            latencies = pool.map(probe_latency, servers)
+        finally:
+            pool.close()
+        self.ctx.logger.info("Puppet masters latencies: {0}".format(
+            ', '.join('{0}: {1}'.format(
+                server, 'unreachable' if latency is None else
+                '{0:.3f}s'.format(latency))
+                for server, latency in zip(servers, latencies))))
+        order = sorted(range(len(servers)), key=lambda i: (
+            latencies[i] is None, latencies[i], i))
+        return [servers[i] for i in order]
 
     def get_runner_cmd(self):
-        return ["agent", "--onetime", "--no-daemonize"]
+        cmd = ["agent", "--onetime", "--no-daemonize"]
+        if len(self.servers) > 1:
+            # The master is passed to the run script, see run_script()
+            cmd.append('${1:+--server "$1"}')
+        return cmd
+
+    def get_run_script(self, cmd, facts_file_name, environ, tags):
+        if not self.props.get('agent_daemon'):
+            return super(PuppetAgentRunner, self).get_run_script(
+                cmd, facts_file_name, environ, tags)
+        if self.props.get('profile'):
+            self.ctx.logger.warn("puppet_config.profile is not supported "
+                                 "with puppet_config.agent_daemon")
+        daemon_cmd = [
+            "puppet", "agent",
+            "--runinterval", str(AGENT_DAEMON_RUNINTERVAL),
+            "--pidfile", AGENT_DAEMON_FILES['pid'],
+            "--logdest", "syslog",
+        ]
+        if tags:
+            daemon_cmd += ['--tags', ','.join(tags)]
+        return AGENT_DAEMON_RUN_TPL.format(
+            pidfile=AGENT_DAEMON_FILES['pid'],
+            tagsfile=AGENT_DAEMON_FILES['tags'],
+            tags=','.join(tags or []),
+            facts_setup=self.get_facts_setup(facts_file_name,
+                                             AGENT_DAEMON_FILES['facts']),
+            environ=environ,
+            cmd=' '.join(daemon_cmd),
+            timeout=int(self.props.get('agent_daemon_timeout',
+                                       DEFAULT_AGENT_DAEMON_TIMEOUT)),
+        )
 
-    def _get_config_file_contents(self):
+    def run_script(self, run_file_name, capture):
+        """ Spreads the load on the masters: waits for a random splay,
+        holds one of the host's run tokens, fails over to the next master
+        and retries with exponential backoff when the masters fail """
         p = self.props
-        node_name = (
+        splay = float(p.get('splay', 0))
+        if splay:
+            delay = random.uniform(0, splay)
+            self.ctx.logger.info("Splay: waiting {0:.1f} seconds before "
+                                 "running Puppet".format(delay))
+            time.sleep(delay)
+        retries = int(p.get('master_retries', 0))
+        retry_delay = float(p.get('master_retry_delay',
+                                  DEFAULT_MASTER_RETRY_DELAY))
+        servers = [None]
+        if len(self.servers) > 1 and not p.get('agent_daemon'):
+            servers = self.get_servers()
+        attempt = 0
+        while True:
+            for server in servers:
+                try:
+                    with self._agent_token():
+                        args = [server] if server else []
+                        return super(PuppetAgentRunner, self).run_script(
+                            run_file_name, capture, *args)
+                except SudoError as exc:
+                    if not MASTER_ERROR_RE.search(str(exc)):
+                        raise
+                    error = exc
+                    if server:
+                        self.ctx.logger.warn(
+                            "Puppet master {0} failed".format(server))
+            if attempt >= retries:
+                raise error
+            delay = min(retry_delay * 2 ** attempt,
+                        MASTER_RETRY_MAX_DELAY)
+            delay = random.uniform(delay / 2, delay)
+            attempt += 1
+            self.ctx.logger.warn(
+                "Puppet master failed, retry {0} of {1} in {2:.1f} "
+                "seconds".format(attempt, retries, delay))
+            time.sleep(delay)
+
+    @contextlib.contextmanager
+    def _agent_token(self):
+        """ Holds one of the puppet_config.agent_concurrency tokens which
+        are shared by the Puppet runs of all the agents on the host """
+        count = int(self.props.get('agent_concurrency', 0))
+        if not count:
+            yield
+            return
+        if not os.path.isdir(AGENT_TOKENS_DIR):
+            os.makedirs(AGENT_TOKENS_DIR)
+        waiting = False
+        while True:
+            for i in range(count):
+                f = open(os.path.join(AGENT_TOKENS_DIR,
+                                      '{0}.lock'.format(i)), 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    f.close()
+                    continue
+                try:
+                    yield
+                finally:
+                    # Releases the lock
+                    f.close()
+                return
+            if not waiting:
+                self.ctx.logger.info("Waiting for one of {0} Puppet run "
+                                     "tokens".format(count))
+                waiting = True
+            time.sleep(AGENT_TOKEN_POLL_INTERVAL)
+
+    def get_node_name(self):
+        p = self.props
+        return (
             p.get('node_name_prefix', '') +
             self.ctx.node_id +
             p.get('node_name_suffix', '')
         )
-        certname = (
+
+    def get_certname(self):
+        """ The certname which is already used by the node instance, if
+        its certificate is on the host. Otherwise a new certname: the node
+        name with puppet_config.stable_certname, else the node name
+        prefixed with the current time. """
+        certname = self.ctx.runtime_properties.get('puppet_certname')
+        if certname and self._ssl_file_exists('certificate', certname):
+            return certname
+        node_name = self.get_node_name()
+        if self.props.get('stable_certname'):
+            return node_name
+        return (
             datetime.datetime.utcnow().strftime('%Y%m%d%H%M') +
             '-' +
             node_name
         )
 
+    def _ssl_file_path(self, key, certname):
+        path, _ = PUPPET_SSL_FILES[key]
+        return os.path.join(PUPPET_SSL_DIR, path.format(certname=certname))
+
+    def _ssl_file_exists(self, key, certname):
+        try:
+            self._sudo('test', '-f', self._ssl_file_path(key, certname))
+        except SudoError:
+            return False
+        return True
+
+    def _get_config_file_contents(self, certname=None):
         conf = PUPPET_CONF_TPL.format(
             environment=self.environment,
             modulepath=self.get_modules_path(),
-            server=self.props['server'],
-            certname=certname,
-            node_name=node_name,
+            server=self.get_servers()[0],
+            certname=certname or self.get_certname(),
+            node_name=self.get_node_name(),
         )
         return conf
 
+    def preseed_ssl(self, certname):
+        """ Installs the SSL material of puppet_config.ssl_preseed, so
+        that the agent does not need to have its certificate signed """
+        preseed = self.props['ssl_preseed']
+        for key in sorted(PUPPET_SSL_FILES):
+            if key not in preseed:
+                raise PuppetParamsError(
+                    "puppet_config.ssl_preseed.{0} is missing".format(key))
+        if self._ssl_file_exists('certificate', certname):
+            return
+        self.ctx.logger.info("Installing SSL material of {0}".format(
+            certname))
+        for key, (_, mode) in sorted(PUPPET_SSL_FILES.items()):
+            with tempfile.NamedTemporaryFile() as f:
+                self._download_to_file(preseed[key], f)
+                self._sudo('install', '-D', '-m', mode, f.name,
+                           self._ssl_file_path(key, certname))
+
+    def write_config_file(self, contents):
+        """ Merges `contents` into the existing puppet.conf, keeping the
+        settings which are not managed by the plugin. The file is only
+        written when it changes. """
+        try:
+            with open(PUPPET_CONF_FILE) as f:
+                existing = f.read()
+        except IOError:
+            try:
+                existing, _ = self._sudo('cat', PUPPET_CONF_FILE)
+            except SudoError:
+                existing = ''
+        if existing.strip():
+            contents = merge_ini(existing, parse_ini(contents))
+        if contents == existing:
+            self.ctx.logger.info("{0} is up to date".format(
+                PUPPET_CONF_FILE))
+            return
+        if existing:
+            self.ctx.logger.info("Updating {0}:\n{1}".format(
+                PUPPET_CONF_FILE, '\n'.join(difflib.unified_diff(
+                    existing.splitlines(), contents.splitlines(),
+                    'before', 'after', lineterm=''))))
+        self._sudo_write_file(PUPPET_CONF_FILE, contents)
+
     def configure(self):
-        contents = self._get_config_file_contents()
-        self._sudo_write_file('/etc/puppet/puppet.conf', contents)
+        certname = self.get_certname()
+        self.write_config_file(self._get_config_file_contents(certname))
+        if self.props.get('ssl_preseed'):
+            self.preseed_ssl(certname)
+        if self.props.get('csr_attributes'):
+            # JSON is valid YAML
+            self._sudo_write_file(CSR_ATTRIBUTES_FILE, json.dumps(
+                self.props['csr_attributes'], indent=4))
+        self.ctx.runtime_properties['puppet_certname'] = certname
 
 
 class PuppetStandaloneRunner(PuppetRunner):
@@ -475,34 +1793,83 @@ class PuppetStandaloneRunner(PuppetRunner):
     def get_run_env_vars(self):
         return {'FACTER_CLOUDIFY_LOCAL_REPO': self.DIRS['local_repo']}
 
+    def get_fingerprint_paths(self):
+        return (super(PuppetStandaloneRunner, self).get_fingerprint_paths() +
+                [self.DIRS['local_repo']])
+
     def get_installed_modules(self):
-        ret = set()
-        # Ugly output parsing :(
         out, _ = self._sudo('puppet', 'module', 'list', '--modulepath',
                             self.get_modules_path())
-        out = out.split()
-        prev = None
-        for cur in out:
-            if cur.startswith('('):
-                ret.add(prev)
-            prev = cur
-        return ret
+        return parse_module_names(out)
+
+    def _install_module(self, module):
+        out, _ = self._sudo('puppet', 'module', 'install', module)
+        return parse_module_names(out)
+
+    def install_modules(self, modules):
+        """
+        Installs the modules which are not installed yet.
+        `puppet module list` runs once. Dependencies pulled in by an
+        earlier `puppet module install` are not installed again.
+        With puppet_config.modules_concurrency > 1 the missing modules are
+        installed in parallel, which is only safe for modules that do not
+        share dependencies.
+        Returns {'installed': [...], 'skipped': [...]}
+        """
+        report = {
+            'installed': [],
+            'skipped': [],
+        }
+        manifest = self.get_image_manifest()
+        baked = set(map(normalize_module_name, (manifest or {}).get(
+            'modules', [])))
+        if all(normalize_module_name(m) in baked for m in modules):
+            installed_modules = baked
+        else:
+            installed_modules = self.get_installed_modules()
+        missing = []
+        for module in modules:
+            name = normalize_module_name(module)
+            if name in installed_modules:
+                report['skipped'].append(module)
+            elif name not in map(normalize_module_name, missing):
+                missing.append(module)
+
+        concurrency = int(self.props.get('modules_concurrency', 1))
+        if concurrency > 1 and len(missing) > 1:
+            pool = ThreadPool(min(concurrency, len(missing)))
+            try:
+                pool.map(self._install_module, missing)
+            finally:
+                pool.close()
+                pool.join()
+            report['installed'] += missing
+        else:
+            for module in missing:
+                if normalize_module_name(module) in installed_modules:
+                    self.ctx.logger.info(
+                        "Module {0} was installed as a dependency".format(
+                            module))
+                    report['skipped'].append(module)
+                    continue
+                installed_modules |= self._install_module(module)
+                report['installed'].append(module)
+
+        self.ctx.logger.info("Modules installed: {0}, skipped: {1}".format(
+            report['installed'], report['skipped']))
+        return report
 
     def configure(self):
         props = self.props
         modules = props.get('modules', [])
         if modules:
-            for module in modules:
-                installed_modules = self.get_installed_modules()
-                if module not in installed_modules:
-                    self._sudo('puppet', 'module', 'install', module)
+            self.install_modules(modules)
         # Download after modules allows overriding
         if 'download' in props:
             download = props['download']
             if not isinstance(download, list):
                 download = [download]
-            for dl in download:
-                self._url_to_dir(dl, self.DIRS['local_repo'])
+            self._urls_to_dir(download, self.DIRS['local_repo'])
 
     def get_runner_cmd(self):
         cmd = [
@@ -530,56 +1897,179 @@ class PuppetStandaloneRunner(PuppetRunner):
 
         return cmd
 
-    def _url_to_dir(self, url, dst_dir):
-        """
-        Downloads .tar.gz from `url` and extracts to `dst_dir`.
-        If URL is relative ("/xyz.tar.gz"), it's fetched using
-        download_resource().
-        """
-
-        if url is None:
-            return
-
-        ctx = self.ctx
-
-        ctx.logger.info(
-            "Downloading from {0} and unpacking to {1}".format(url, dst_dir))
-        temp_archive = tempfile.NamedTemporaryFile(
-            suffix='.url_to_dir.tar.gz', delete=False)
-
-        is_resource, path = is_resource_url(url)
-        if is_resource:
-            ctx.logger.info("Getting resource {0} to {1}".format(path,
-                            temp_archive.name))
-            ctx.download_resource(path, temp_archive.name)
-        else:
-            ctx.logger.info("Downloading from {0} to {1}".format(url,
-                            temp_archive.name))
-            temp_archive.write(requests.get(url).content)
-            temp_archive.flush()
-            temp_archive.close()
-
-        command_list = [
-            'sudo',
-            'tar', '-C', dst_dir,
+    def _tar_command(self, dst_dir, archive, extract_dir=None):
+        """ Extracts `archive` to `dst_dir`, or to `extract_dir` as if it
+        was `dst_dir` """
+        return [
+            'tar', '-C', extract_dir or dst_dir,
             '--xform', 's#^' + os.path.basename(dst_dir) + '/##',
-            '-xzf', temp_archive.name]
+            '-xzf', archive]
+
+    def _extract_archive(self, archive, dst_dir, url):
+        command_list = self._tar_command(dst_dir, archive)
         try:
-            ctx.logger.info("Running: '%s'", ' '.join(command_list))
-            subprocess.check_call(command_list)
-        except subprocess.CalledProcessError as exc:
+            self._sudo(*command_list, capture=False)
+        except SudoError as exc:
             raise PuppetError("Failed to extract file {0} to directory {1} "
                               "which was downloaded from {2}. Command: {3}. "
                               "Exception: {4}".format(
-                                  temp_archive.name,
+                                  archive,
                                   dst_dir,
                                   url,
                                   command_list,
                                   exc))
 
-        os.remove(temp_archive.name)  # on failure, leave for debugging
-        # try:
-        #     os.rmdir(os.path.join(dst_dir, os.path.basename(dst_dir)))
-        # except OSError as e:
-        #     if e.errno != errno.ENOENT:
-        #         raise e
+    def _stream_url_to_dir(self, url, dst_dir):
+        """
+        Downloads .tar.gz from `url` straight into the standard input
+        of tar which extracts it to `dst_dir`. No temporary file is used.
+        With a download_checksums entry for `url`, the archive is
+        extracted to a staging directory next to `dst_dir` which is
+        merged into `dst_dir` only once the checksum matched.
+        """
+        expected_digest = self.props.get('download_checksums', {}).get(url)
+        if not expected_digest:
+            self._stream_url_to_dir_unverified(url, dst_dir, dst_dir, None)
+            return
+        staging_dir = self._sudo(
+            'mktemp', '-d', os.path.join(
+                os.path.dirname(dst_dir),
+                '.' + os.path.basename(dst_dir) + '.XXXXXX'))[0].strip()
+        try:
+            self._stream_url_to_dir_unverified(url, dst_dir, staging_dir,
+                                               expected_digest)
+            self._sudo('cp', '-a', staging_dir + '/.', dst_dir)
+        finally:
+            self._sudo('rm', '-rf', '--', staging_dir)
+
+    def _stream_url_to_dir_unverified(self, url, dst_dir, extract_dir,
+                                      expected_digest):
+        """ Streams `url` to tar, extracting to `extract_dir` as if it was
+        `dst_dir`. A mismatch of `expected_digest` is only detected once
+        the archive was extracted. """
+        props = self.props
+        command_list = self._tar_command(dst_dir, '-', extract_dir)
+        self.ctx.logger.info("Downloading from {0} and running: '{1}'".format(
+            url, ' '.join(command_list)))
+        proc = self._sudo_popen(command_list)
+        response = None
+        download_error = None
+        try:
+            response, _ = stream_download(
+                url, proc.stdin,
+                chunk_size=props.get('download_chunk_size'),
+                retries=props.get('download_retries'),
+                expected_digest=expected_digest)
+        except (DownloadError, requests.RequestException) as exc:
+            download_error = exc
+        except IOError:
+            # tar exited early, its exit code tells why
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except IOError:
+                pass
+            exit_code = proc.wait()
+        if download_error:
+            raise PuppetError("Failed to download {0}: {1}".format(
+                url, download_error))
+        if response is not None and \
+                response.status_code != requests.codes.ok:
+            raise PuppetError("Failed to download {0}: HTTP {1}".format(
+                url, response.status_code))
+        if exit_code:
+            raise PuppetError("Failed to extract archive downloaded from {0} "
+                              "to directory {1}. Command: {2}. "
+                              "Exit code: {3}".format(
+                                  url, dst_dir, command_list, exit_code))
+
+    def _urls_to_dir(self, urls, dst_dir):
+        """
+        Downloads .tar.gz files from `urls` and extracts them, in order,
+        to `dst_dir`. Extraction is skipped when the same archives were
+        the last ones extracted to `dst_dir`.
+        Returns {'changed': [...], 'deleted': [...]} or None when the
+        changes are not tracked (no delta sync).
+        """
+        ctx = self.ctx
+        urls = [url for url in urls if url is not None]
+        if not urls:
+            return None
+
+        cache = DownloadCache.from_props(ctx.logger, self.props)
+        if self.props.get('download_streaming'):
+            # download_resource() only writes to files so resources
+            # still go through the cache
+            cache.set_extracted(dst_dir, [])
+            cache.set_tree(dst_dir, {})
+            for url in urls:
+                if is_resource_url(url)[0]:
+                    self._extract_archive(
+                        self._fetch_archive(cache, url)[0], dst_dir, url)
+                else:
+                    self._stream_url_to_dir(url, dst_dir)
+            cache.evict()
+            return None
+
+        archives = [self._fetch_archive(cache, url) for url in urls]
+        digests = [digest for _, digest in archives]
+        changes = None
+        if cache.is_extracted(dst_dir, digests):
+            ctx.logger.info("Archives from {0} are already extracted to {1}, "
+                            "skipping".format(urls, dst_dir))
+            changes = {'changed': [], 'deleted': []}
+        elif self.props.get('download_delta_sync'):
+            changes = self._delta_sync(
+                cache, [archive for archive, _ in archives], dst_dir)
+            cache.set_extracted(dst_dir, digests)
+        else:
+            # Whatever the last delta sync recorded is not known to be
+            # there any more
+            cache.set_tree(dst_dir, {})
+            for (archive, _), url in zip(archives, urls):
+                ctx.logger.info("Unpacking {0} to {1}".format(url, dst_dir))
+                self._extract_archive(archive, dst_dir, url)
+            cache.set_extracted(dst_dir, digests)
+        cache.evict()
+        return changes
+
+    def _delta_sync(self, cache, archives, dst_dir):
+        """
+        Writes to `dst_dir` only the files from `archives` which changed
+        since the last sync and removes the ones which were deleted.
+        Returns {'changed': [...], 'deleted': [...]}
+        """
+        ctx = self.ctx
+        previous = {}
+        if os.path.isdir(dst_dir):
+            previous = cache.get_tree(dst_dir)
+        command_list = ['tar', '-C', dst_dir, '-xf', '-']
+        procs = []
+
+        def open_out():
+            ctx.logger.info("Running: '%s'", ' '.join(command_list))
+            procs.append(self._sudo_popen(command_list))
+            return procs[0].stdin
+
+        try:
+            tree, changed, deleted = write_archives_delta(
+                archives, os.path.basename(dst_dir), previous, open_out)
+        except (IOError, tarfile.TarError) as exc:
+            raise PuppetError("Failed to sync archives {0} to directory {1}: "
+                              "{2}".format(archives, dst_dir, exc))
+        finally:
+            if procs:
+                procs[0].stdin.close()
+                exit_code = procs[0].wait()
+        if procs and exit_code:
+            raise PuppetError("Failed to sync archives {0} to directory {1}. "
+                              "Command: {2}. Exit code: {3}".format(
+                                  archives, dst_dir, command_list, exit_code))
+        if deleted:
+            self._sudo('rm', '-f', '--',
+                       *[os.path.join(dst_dir, path) for path in deleted])
+        cache.set_tree(dst_dir, tree)
+        ctx.logger.info("Synced {0}: {1} changed, {2} deleted".format(
+            dst_dir, len(changed), len(deleted)))
+        return {'changed': changed, 'deleted': deleted}
@@ -78,17 +78,97 @@ def _prepare_tags(ctx, props, op):
     return tags
 
 
-@_operation
-def operation(ctx, **kwargs):
+def _get_batch(props, op):
+    """ Returns the operations which are run together with `op`:
+    `op` and the operations after it in its puppet_config.operations_batches
+    batch. None if `op` is not in any batch """
+    for batch in props.get('operations_batches', []):
+        if not isinstance(batch, list):
+            raise PuppetParamsError(
+                "Operations batch must be a list, not {0}".format(batch))
+        if op in batch:
+            return batch[batch.index(op):]
+    return None
+
+
+def _batch_tags(ctx, props, batch):
+    """ Union of tags of all operations in `batch`, None if none
+    of them has tags. [] (full catalog run) if any of them would run
+    untagged on its own: 'start' without specific tags or an operation
+    without any tags """
+    tags = None
+    for op in batch:
+        op_tags = _prepare_tags(ctx, props, op)
+        if op_tags is None:
+            if op == 'start':
+                return []
+            continue
+        if not op_tags:
+            return []
+        tags = tags or []
+        tags += [tag for tag in op_tags if tag not in tags]
+    return tags
 
-    op = _extract_op(ctx)
-    props = ctx.properties['puppet_config']
 
-    mgr = PuppetManager(ctx)
-    # print(mgr, isinstance(mgr, PuppetStandaloneRunner))
+def _get_batch_runs(ctx):
+    return ctx.runtime_properties.get('puppet_batch_runs', {})
+
+
+def _record_batch_run(ctx, batch):
+    """ Attributes the run of `batch` to each of its operations """
+    runs = dict(_get_batch_runs(ctx))
+    for op in batch:
+        runs[op] = {
+            'run_by': batch[0],
+            'execution_id': getattr(ctx, 'execution_id', None),
+        }
+    ctx.runtime_properties['puppet_batch_runs'] = runs
+
+
+def _covered_by_batch(ctx, op):
+    """ Returns the operation which ran Puppet for `op` in this
+    execution, if any """
+    run = _get_batch_runs(ctx).get(op)
+    if not run or run['run_by'] == op:
+        return None
+    if run['execution_id'] != getattr(ctx, 'execution_id', None):
+        return None
+    return run['run_by']
+
+
+def _standalone_dsl(ctx, props, op):
+    """ The (execute, manifest) of operation `op` """
+    e = _op_specifc(ctx, props, op, 'execute')
+    m = _op_specifc(ctx, props, op, 'manifest')
+
+    if e and m:
+        raise RuntimeError("Either 'execute' or 'manifest' " +
+                           "must be specified for given operation. " +
+                           "Both are specified for operation {0}".format(
+                               op))
+    return e, m
+
+
+def _run_operation(ctx, mgr, props, op):
     tags = _prepare_tags(ctx, props, op)
 
     if isinstance(mgr, PuppetAgentRunner):
+        batch = _get_batch(props, op)
+        if batch:
+            run_by = _covered_by_batch(ctx, op)
+            if run_by:
+                ctx.logger.info("Puppet already ran for operation '{0}' "
+                                "in operation '{1}'".format(op, run_by))
+                return
+            tags = _batch_tags(ctx, props, batch)
+            if 'start' not in batch and tags is None:
+                ctx.logger.info("No tags specific to operations {0}, "
+                                "skipping".format(batch))
+                return
+            ctx.logger.info("Running Puppet for operations {0}".format(batch))
+            mgr.run(tags=(tags or []))
+            _record_batch_run(ctx, batch)
+            return
         if op != 'start' and tags is None:
             ctx.logger.info("No tags specific to operation '{0}', skipping".
                             format(op))
@@ -97,17 +177,55 @@ def operation(ctx, **kwargs):
         return
 
     if isinstance(mgr, PuppetStandaloneRunner):
-        e = _op_specifc(ctx, props, op, 'execute')
-        m = _op_specifc(ctx, props, op, 'manifest')
-
-        if e and m:
-            raise RuntimeError("Either 'execute' or 'manifest' " +
-                               "must be specified for given operation. " +
-                               "Both are specified for operation {0}".format(
-                                   op))
-
+        e, m = _standalone_dsl(ctx, props, op)
         if e or m:
             mgr.run(tags=(tags or []), execute=e, manifest=m)
         return
 
     raise RuntimeError("Internal error: unknown Puppet Runner")
+
+
+def _run_puppet_operation(ctx, mgr, props, puppet_operation):
+    tags = _prepare_tags(ctx, props, puppet_operation)
+
+    if isinstance(mgr, PuppetAgentRunner):
+        mgr.run(tags=(tags or []))
+        return
+
+    if isinstance(mgr, PuppetStandaloneRunner):
+        e, m = _standalone_dsl(ctx, props, puppet_operation)
+        if not (e or m):
+            ctx.logger.info("No 'execute' or 'manifest' for operation "
+                            "'{0}', skipping".format(puppet_operation))
+            return
+        mgr.run(tags=(tags or []), execute=e, manifest=m)
+        return
+
+    raise RuntimeError("Internal error: unknown Puppet Runner")
+
+
+@_operation
+def operation(ctx, **kwargs):
+
+    op = _extract_op(ctx)
+    props = ctx.properties['puppet_config']
+
+    mgr = PuppetManager(ctx)
+    try:
+        _run_operation(ctx, mgr, props, op)
+    finally:
+        mgr.close()
+
+
+@_operation
+def run(ctx, puppet_operation='start', **kwargs):
+    """ Runs Puppet with the tags (agent) or the DSL (standalone) of the
+    `puppet_operation` lifecycle operation. Unlike operation(), tags are
+    not required. Used by the run_puppet workflow. """
+    props = ctx.properties['puppet_config']
+
+    mgr = PuppetManager(ctx)
+    try:
+        _run_puppet_operation(ctx, mgr, props, puppet_operation)
+    finally:
+        mgr.close()
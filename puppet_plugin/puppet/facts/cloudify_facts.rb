@@ -2,15 +2,14 @@
 # https://raw.githubusercontent.com/CloudifySource/cloudify-recipes/master/services/puppet/custom_facts/cloudify_facts.rb
 
 #Load cloudify attributes into puppet
-require 'json'
 
 env_var = 'CLOUDIFY_FACTS_FILE'
 
-if not ENV.has_key?(env_var) then
-  raise "Environment variable #{env_var} is not set"
-end
-
-attributes = JSON.parse(IO.read(ENV[env_var]))
+# nested: facts file has nested hashes, flattened here
+# flat: facts file is already flattened by the plugin, values are strings
+# structured: top level keys become structured facts (Puppet 3.5+)
+# external: facts are read by Facter from facts.d, nothing to do here
+format = ENV['CLOUDIFY_FACTS_FORMAT'] || 'nested'
 
 class Hash
     def flatten_to_hash(current_prefix="", separator="_")
@@ -28,11 +27,24 @@ class Hash
     end
 end
 
-attributes.flatten_to_hash.each do |key, value|
-  Facter.add(key) do
-    setcode do
-      value.to_s
+if format != 'external' then
+  require 'json'
+
+  if not ENV.has_key?(env_var) then
+    raise "Environment variable #{env_var} is not set"
+  end
+
+  attributes = JSON.parse(IO.read(ENV[env_var]))
+
+  if format == 'nested' then
+    attributes = attributes.flatten_to_hash
+  end
+
+  attributes.each do |key, value|
+    Facter.add(key) do
+      setcode do
+        format == 'structured' ? value : value.to_s
+      end
     end
   end
 end
-
@@ -0,0 +1,46 @@
+# Prints a compact JSON summary of a Puppet run report
+# Usage: ruby report_summary.rb LAST_RUN_REPORT_YAML [TOP_N]
+
+require 'puppet'
+require 'json'
+
+report_file = ARGV[0]
+top = (ARGV[1] || 10).to_i
+
+report = YAML.load_file(report_file)
+
+metrics = {}
+report.metrics.each do |name, metric|
+  metrics[name] = {}
+  metric.values.each do |key, label, value|
+    metrics[name][key.to_s] = value
+  end
+end
+
+slowest = report.resource_statuses.values.
+  select { |status| status.evaluation_time }.
+  sort_by { |status| -status.evaluation_time }.
+  first(top).
+  map do |status|
+    {
+      'resource' => status.resource,
+      'file' => status.file,
+      'line' => status.line,
+      'time' => status.evaluation_time,
+    }
+  end
+
+time = metrics['time'] || {}
+summary = {
+  'status' => report.status,
+  'resources' => metrics['resources'] || {},
+  'events' => metrics['events'] || {},
+  'time' => {
+    'total' => time['total'],
+    'config_retrieval' => time['config_retrieval'],
+  },
+  'slowest_resources' => slowest,
+  'report_time' => report.time.to_f,
+}
+
+puts JSON.generate(summary)
@@ -0,0 +1,356 @@
+""" Privileged helper, see puppet_config.sudo_helper. One process, started
+once with sudo, runs the commands and writes the files which would
+otherwise take a sudo invocation each.
+
+The protocol is one JSON object per line in both directions. Requests
+have an 'id' and an 'op':
+  run - runs 'cmd', killing it after 'timeout' seconds (unless null).
+        With 'stdin' true, the standard input of the command is fed by
+        'stdin' requests ('data' in base64), each answered with an 'ack'
+        message once written, and closed by a 'stdin_eof' request.
+        Answered with 'stream' ('out' or 'err') and 'data' messages for
+        each line of output, 'tick' messages while the command runs and
+        a last 'exit' and 'timed_out' message.
+  write - atomically replaces 'path' with 'data' (base64), with 'mode'.
+          Answered with an 'exit' message, which has 'error' on failure.
+Messages have the 'id' of their request. Each request is handled by its
+own threads so a slow command does not hold up the others. The helper
+exits when its standard input is closed.
+
+This file is executed by root as a script, it must only use the
+standard library.
+"""
+
+import base64
+import itertools
+import json
+import os
+import Queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HELPER_SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+TICK_INTERVAL = 1
+# Seconds to keep reading the output of a command after it exited
+DRAIN_TIMEOUT = 2
+# Chunks of standard input sent to the helper but not written yet
+STDIN_WINDOW = 16
+
+
+class SudoHelperError(RuntimeError):
+    """ The helper failed or exited """
+
+
+# *** Helper side ***
+
+
+class _Output(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def send(self, msg):
+        line = json.dumps(msg) + '\n'
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+def _terminate(proc, grace=10):
+    """ SIGTERM, then SIGKILL """
+    try:
+        proc.terminate()
+        for _ in range(grace * 10):
+            if proc.poll() is not None:
+                return
+            time.sleep(0.1)
+        proc.kill()
+    except OSError:
+        pass
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _feed(msg, pipe, chunks, out):
+    """ Writes `chunks` to the standard input of a command. `pipe` is None
+    when the command failed to start, the chunks are then dropped """
+    for data in iter(chunks.get, None):
+        if pipe:
+            try:
+                pipe.write(data)
+            except IOError:
+                # the command exited, its exit code tells why
+                pipe = None
+        out.send({'id': msg['id'], 'ack': True})
+    if pipe:
+        try:
+            pipe.close()
+        except IOError:
+            pass
+
+
+def _run(msg, chunks, out, devnull):
+    cmd = [arg.encode('utf-8') for arg in msg['cmd']]
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if chunks else devnull,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            close_fds=True)
+    except OSError as exc:
+        if chunks:
+            _start(_feed, msg, None, chunks, out)
+        out.send({'id': msg['id'], 'stream': 'err',
+                  'data': '{0}: {1}\n'.format(cmd[0], exc)})
+        out.send({'id': msg['id'], 'exit': 1, 'timed_out': False})
+        return
+    if chunks:
+        _start(_feed, msg, proc.stdin, chunks, out)
+
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def read(name, pipe):
+        for line in iter(pipe.readline, b''):
+            with lock:
+                if done.is_set():
+                    break
+                out.send({'id': msg['id'], 'stream': name,
+                          'data': line.decode('latin-1')})
+        pipe.close()
+
+    readers = [_start(read, 'out', proc.stdout),
+               _start(read, 'err', proc.stderr)]
+    # Done when the command exits, background processes which it left
+    # running may keep its output open
+    waiter = _start(proc.wait)
+    timeout = msg.get('timeout')
+    deadline = timeout and (time.time() + timeout)
+    timed_out = False
+    while waiter.is_alive():
+        waiter.join(TICK_INTERVAL)
+        out.send({'id': msg['id'], 'tick': True})
+        if deadline and not timed_out and time.time() > deadline:
+            timed_out = True
+            _terminate(proc)
+    drain_deadline = time.time() + DRAIN_TIMEOUT
+    for reader in readers:
+        reader.join(max(0, drain_deadline - time.time()))
+    with lock:
+        done.set()
+    out.send({'id': msg['id'], 'exit': proc.returncode,
+              'timed_out': timed_out})
+
+
+def _write(msg, out):
+    path = msg['path']
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   prefix='.' + os.path.basename(path) + '.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(base64.b64decode(msg['data']))
+        os.chmod(tmp, int(msg.get('mode', '600'), 8))
+        os.rename(tmp, path)
+    except (IOError, OSError) as exc:
+        if tmp:
+            os.remove(tmp)
+        out.send({'id': msg['id'], 'exit': 1, 'error': str(exc)})
+        return
+    out.send({'id': msg['id'], 'exit': 0})
+
+
+def serve(stdin, stdout):
+    """ Reads the requests. Never blocks on a command, the standard input
+    of commands is queued for their feeder threads. """
+    out = _Output(stdout)
+    devnull = open(os.devnull, 'rb')
+    stdins = {}
+    for line in iter(stdin.readline, ''):
+        msg = json.loads(line)
+        op = msg['op']
+        if op == 'run':
+            chunks = None
+            if msg.get('stdin'):
+                chunks = stdins[msg['id']] = Queue.Queue()
+            _start(_run, msg, chunks, out, devnull)
+        elif op == 'stdin':
+            stdins[msg['id']].put(base64.b64decode(msg['data']))
+        elif op == 'stdin_eof':
+            stdins.pop(msg['id']).put(None)
+        elif op == 'write':
+            _start(_write, msg, out)
+
+
+# *** Client side ***
+
+
+def _dispatch(pipe, handlers, lock):
+    """ Hands the messages of the helper to the handlers of the requests,
+    None once the helper exited. `lock` only guards `handlers`. Does not
+    reference the SudoHelper, so that it can be collected. """
+    for line in iter(pipe.readline, b''):
+        msg = json.loads(line)
+        with lock:
+            handler = handlers.get(msg['id'])
+        if handler:
+            handler(msg)
+    with lock:
+        remaining = handlers.values()
+    for handler in remaining:
+        handler(None)
+
+
+class SudoHelper(object):
+    """ Starts the helper and sends it requests. Thread safe. """
+
+    def __init__(self, argv=None):
+        self.proc = subprocess.Popen(
+            argv or ['/usr/bin/sudo', sys.executable, HELPER_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        # Guards handlers. Never held while writing to the helper.
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.handlers = {}
+        _start(_dispatch, self.proc.stdout, self.handlers, self.lock)
+
+    def _open(self, on_ack=None):
+        """ Registers a request. Returns its id and the queue of its
+        messages. Acks go to on_ack() instead of the queue. """
+        queue = Queue.Queue()
+
+        def handle(msg):
+            if on_ack and (msg is None or 'ack' in msg):
+                on_ack()
+            if msg is None or 'ack' not in msg:
+                queue.put(msg)
+
+        with self.lock:
+            request_id = next(self.ids)
+            self.handlers[request_id] = handle
+        return request_id, queue
+
+    def _close_request(self, request_id):
+        with self.lock:
+            self.handlers.pop(request_id, None)
+
+    def _send(self, msg):
+        line = json.dumps(msg) + '\n'
+        with self.write_lock:
+            try:
+                self.proc.stdin.write(line)
+                self.proc.stdin.flush()
+            except (IOError, ValueError) as exc:
+                raise SudoHelperError("Failed to send to the sudo helper: "
+                                      "{0}".format(exc))
+
+    @staticmethod
+    def _get(queue):
+        msg = queue.get()
+        if msg is None:
+            raise SudoHelperError("The sudo helper exited")
+        return msg
+
+    def _wait(self, request_id, queue, on_line, on_tick=None):
+        try:
+            while True:
+                msg = self._get(queue)
+                if 'stream' in msg:
+                    on_line(msg['stream'], msg['data'].encode('latin-1'))
+                elif 'tick' in msg:
+                    if on_tick:
+                        on_tick()
+                else:
+                    return msg['exit'], msg['timed_out']
+        finally:
+            self._close_request(request_id)
+
+    def run(self, cmd, on_line, on_tick, timeout=None):
+        """ Runs `cmd`. Calls on_line(stream, line) for each line of its
+        output, stream is 'out' or 'err', and on_tick() periodically.
+        Returns (exit code, whether it timed out) """
+        request_id, queue = self._open()
+        try:
+            self._send({'id': request_id, 'op': 'run', 'cmd': list(cmd),
+                        'timeout': timeout})
+        except SudoHelperError:
+            self._close_request(request_id)
+            raise
+        return self._wait(request_id, queue, on_line, on_tick)
+
+    def popen(self, cmd, on_line):
+        """ Starts `cmd` for writing to its standard input. Returns an
+        object with `stdin` and wait(), like subprocess.Popen """
+        return _HelperProcess(self, cmd, on_line)
+
+    def write_file(self, path, data, mode='600'):
+        request_id, queue = self._open()
+        try:
+            self._send({'id': request_id, 'op': 'write', 'path': path,
+                        'data': base64.b64encode(data), 'mode': mode})
+            msg = self._get(queue)
+        finally:
+            self._close_request(request_id)
+        if msg['exit']:
+            raise SudoHelperError("Failed to write {0}: {1}".format(
+                path, msg['error']))
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        self.proc.wait()
+
+
+class _HelperStdin(object):
+    """ At most STDIN_WINDOW chunks are in flight, so the helper does not
+    buffer more than that when the command reads slowly """
+
+    def __init__(self, helper, request_id, window):
+        self.helper = helper
+        self.request_id = request_id
+        self.window = window
+        self.closed = False
+
+    def write(self, data):
+        if data:
+            self.window.acquire()
+            self.helper._send({'id': self.request_id, 'op': 'stdin',
+                               'data': base64.b64encode(data)})
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.helper._send({'id': self.request_id, 'op': 'stdin_eof'})
+
+
+class _HelperProcess(object):
+
+    def __init__(self, helper, cmd, on_line):
+        self.helper = helper
+        self.on_line = on_line
+        window = threading.Semaphore(STDIN_WINDOW)
+        self.request_id, self.queue = helper._open(on_ack=window.release)
+        helper._send({'id': self.request_id, 'op': 'run', 'cmd': list(cmd),
+                      'timeout': None, 'stdin': True})
+        self.stdin = _HelperStdin(helper, self.request_id, window)
+
+    def wait(self):
+        returncode, _ = self.helper._wait(self.request_id, self.queue,
+                                          self.on_line)
+        return returncode
+
+
+if __name__ == '__main__':
+    serve(sys.stdin, sys.stdout)
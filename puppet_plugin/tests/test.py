@@ -1,12 +1,39 @@
 import datetime
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
 import re
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
 import unittest
 
+import requests
 from cloudify.mocks import MockCloudifyContext
+import puppet_plugin.manager
 import puppet_plugin.operations
-operation = puppet_plugin.operations.operation
 from puppet_plugin.manager import (
-    PuppetManager, PuppetRunner, PuppetAgentRunner, PuppetStandaloneRunner)
+    CSR_ATTRIBUTES_FILE, PuppetError, PuppetManager, PuppetParamsError,
+    PuppetRunner, PuppetAgentRunner, PuppetStandaloneRunner,
+    PuppetDebianInstaller, PuppetRHELInstaller,
+    SudoError, bound_facts, flatten_facts, format_external_facts,
+    format_profile_table, merge_ini, parse_ini, parse_module_names,
+    parse_profile, select_facts)
+import puppet_plugin.downloads
+from puppet_plugin.downloads import (
+    DownloadCache, stream_download, write_archives_delta)
+from puppet_plugin.sudo_helper import (
+    HELPER_SCRIPT, SudoHelper, SudoHelperError)
+from puppet_plugin.workflows import converge, format_results_table
+
+operation = puppet_plugin.operations.operation
 
 
 # Warning: Singleton
@@ -23,6 +50,9 @@ class MockPuppetManager(object):
         MockPuppetManager.execute = execute
         MockPuppetManager.manifest = manifest
 
+    def close(self):
+        pass
+
 
 class MockAgentPuppetManager(MockPuppetManager, PuppetAgentRunner):
     pass
@@ -32,6 +62,28 @@ class MockStandalonePuppetManager(MockPuppetManager, PuppetStandaloneRunner):
     pass
 
 
+def make_context(props, **kwargs):
+    """ Context of the node instance 'node_id' of 'node_name', with `props`
+    as its puppet_config """
+    kwargs.setdefault('node_name', 'node_name')
+    kwargs.setdefault('node_id', 'node_id')
+    return MockCloudifyContext(properties={'puppet_config': props}, **kwargs)
+
+
+class ProcessCacheTestCase(unittest.TestCase):
+    """ Every test starts with a _PROCESS_CACHE holding only PROCESS_CACHE,
+    the original one is restored after the test """
+
+    PROCESS_CACHE = {}
+
+    def setUp(self):
+        cache = puppet_plugin.manager._PROCESS_CACHE
+        self.addCleanup(cache.update, dict(cache))
+        self.addCleanup(cache.clear)
+        cache.clear()
+        cache.update(self.PROCESS_CACHE)
+
+
 class PuppetTest(unittest.TestCase):
 
     server = 'puppet-master-server-name'
@@ -102,6 +154,47 @@ class PuppetTest(unittest.TestCase):
             operation(ctx)
             self.assertIn('cloudify_operation_start', MockPuppetManager.tags)
 
+    def test_operations_batches(self):
+        runtime_properties = {}
+        for op in 'create', 'configure', 'start':
+            ctx = self._make_agent_context(
+                properties={
+                    'operations_tags': {
+                        'create': 'op_tag_create',
+                        'configure': ['op_tag_configure'],
+                    },
+                    'operations_batches': [['create', 'configure']],
+                },
+                operation=op)
+            ctx.runtime_properties.update(runtime_properties)
+            MockPuppetManager.tags = None
+            operation(ctx)
+            runtime_properties = ctx.runtime_properties
+            if op == 'create':
+                self.assertEqual(MockPuppetManager.tags,
+                                 ['op_tag_create', 'op_tag_configure'])
+            elif op == 'configure':
+                self.assertIsNone(MockPuppetManager.tags)
+            else:
+                self.assertEqual(MockPuppetManager.tags, [])
+        self.assertEqual(
+            runtime_properties['puppet_batch_runs']['configure']['run_by'],
+            'create')
+
+    def test_operations_batches_untagged(self):
+        for props, expected in (
+                ({'operations_tags': {'create': ['a']}}, []),
+                ({'operations_tags': {'create': ['a'], 'start': ['b']}},
+                 ['a', 'b']),
+                ({'tags': ['t']}, ['t']),
+                ({}, [])):
+            props['operations_batches'] = [['create', 'configure', 'start']]
+            ctx = self._make_agent_context(properties=props,
+                                           operation='create')
+            MockPuppetManager.tags = None
+            operation(ctx)
+            self.assertEqual(MockPuppetManager.tags, expected)
+
     def _get_config_file(self, *args, **kwargs):
         ctx = self._make_agent_context(*args, **kwargs)
         mgr = PuppetManager(ctx)
@@ -152,6 +245,18 @@ class PuppetTest(unittest.TestCase):
         for tag in tags:
             self.assertIn(tag, MockPuppetManager.tags)
 
+    def test_agent_daemon(self):
+        ctx = self._make_agent_context(properties={
+            'environment': 'e1',
+            'agent_daemon': True,
+        })
+        mgr = PuppetManager(ctx)
+        script = mgr.get_run_script('puppet agent', '/tmp/facts.json', '',
+                                    ['t1', 't2'])
+        self.assertIn('kill -USR1', script)
+        self.assertIn("tags='t1,t2'", script)
+        self.assertNotIn('--onetime', script)
+
     def test_runner_choosing(self):
 
         ctx = self._make_agent_context()
@@ -161,3 +266,1169 @@ class PuppetTest(unittest.TestCase):
         ctx = self._make_standalone_context()
         runner = PuppetRunner.get_runner_class(ctx)
         self.assertEquals(runner, PuppetStandaloneRunner)
+
+
+class PuppetProcessCacheTest(ProcessCacheTestCase):
+
+    def setUp(self):
+        super(PuppetProcessCacheTest, self).setUp()
+        self.orig_prog_available = PuppetManager._prog_available_for_root
+        self.probes = []
+
+        def prog_available(mgr, prog):
+            self.probes.append(prog)
+            return True
+        PuppetManager._prog_available_for_root = prog_available
+
+    def tearDown(self):
+        PuppetManager._prog_available_for_root = self.orig_prog_available
+
+    def _make_manager(self):
+        ctx = make_context({'server': 's', 'environment': 'e'})
+        return PuppetManager(ctx)
+
+    def test_cached(self):
+        mgr1 = self._make_manager()
+        mgr2 = self._make_manager()
+        self.assertIs(type(mgr1), type(mgr2))
+        self.assertTrue(mgr1.puppet_is_installed())
+        self.assertTrue(mgr2.puppet_is_installed())
+        self.assertEqual(self.probes, ['puppet'])
+
+
+class PuppetRunCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        ctx = make_context({'execute': {}})
+        self.mgr = MockSudoStandaloneRunner(ctx)
+
+    def test_output(self):
+        out, err = self.mgr._run_command(
+            ['sh', '-c', 'echo out1; echo err1 >&2; echo out2'])
+        self.assertEqual(out, 'out1\nout2\n')
+        self.assertEqual(err, 'err1\n')
+
+    def test_failure_tail(self):
+        cmd = ['sh', '-c', 'seq 1 1000; exit 3']
+        with self.assertRaises(SudoError) as cm:
+            self.mgr._run_command(cmd, capture=False)
+        message = str(cm.exception)
+        self.assertIn('exit status 3', message)
+        self.assertIn('\n1000\n', message)
+        self.assertNotIn('\n1\n', message)
+
+    def test_timeout(self):
+        with self.assertRaises(SudoError) as cm:
+            self.mgr._run_command(['sleep', '10'], timeout=0.5)
+        self.assertIn('timed out', str(cm.exception))
+
+    def test_background_child(self):
+        # The child keeps the output pipes open after the command exited
+        started = time.time()
+        out, _ = self.mgr._run_command(
+            ['sh', '-c', 'sleep 30 & echo started'])
+        self.assertEqual(out, 'started\n')
+        self.assertLess(time.time() - started, 10)
+
+
+class SudoHelperTest(unittest.TestCase):
+    """ The helper runs as the current user, without sudo """
+
+    def setUp(self):
+        ctx = make_context({'execute': {}})
+        self.mgr = MockSudoStandaloneRunner(ctx)
+        self.helper = SudoHelper([sys.executable, HELPER_SCRIPT])
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.helper.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_output(self):
+        out, err = self.mgr._run_command(
+            ['sh', '-c', 'echo out1; echo err1 >&2; echo out2'],
+            helper=self.helper)
+        self.assertEqual(out, 'out1\nout2\n')
+        self.assertEqual(err, 'err1\n')
+
+    def test_failure(self):
+        with self.assertRaises(SudoError) as cm:
+            self.mgr._run_command(['sh', '-c', 'echo failed; exit 3'],
+                                  helper=self.helper)
+        self.assertIn('exit status 3', str(cm.exception))
+        self.assertIn('failed', str(cm.exception))
+        with self.assertRaises(SudoError):
+            self.mgr._run_command(['/nonexistent'], helper=self.helper)
+
+    def test_timeout(self):
+        with self.assertRaises(SudoError) as cm:
+            self.mgr._run_command(['sleep', '10'], timeout=0.5,
+                                  helper=self.helper)
+        self.assertIn('timed out', str(cm.exception))
+
+    def test_background_child(self):
+        started = time.time()
+        out, _ = self.mgr._run_command(
+            ['sh', '-c', 'sleep 30 & echo started'], helper=self.helper)
+        self.assertEqual(out, 'started\n')
+        self.assertLess(time.time() - started, 10)
+
+    def test_write_file(self):
+        path = os.path.join(self.tmp_dir, 'f')
+        self.helper.write_file(path, 'data\n', mode='644')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'data\n')
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o644)
+        with self.assertRaises(SudoHelperError):
+            self.helper.write_file(os.path.join(self.tmp_dir, 'd', 'f'), '')
+
+    def test_stdin(self):
+        path = os.path.join(self.tmp_dir, 'f')
+        proc = self.helper.popen(['sh', '-c', 'cat > ' + path],
+                                 lambda name, line: None)
+        for _ in range(3):
+            proc.stdin.write('x' * 100000)
+        proc.stdin.close()
+        self.assertEqual(proc.wait(), 0)
+        self.assertEqual(os.path.getsize(path), 300000)
+
+    def test_stdin_with_output(self):
+        path = os.path.join(self.tmp_dir, 'f')
+        lines = []
+        proc = self.helper.popen(
+            ['sh', '-c', 'seq 1 200000 >&2; cat > ' + path],
+            lambda name, line: lines.append(line))
+        for _ in range(1000):
+            proc.stdin.write('x' * 1000)
+        proc.stdin.close()
+        self.assertEqual(proc.wait(), 0)
+        self.assertEqual(len(lines), 200000)
+        self.assertEqual(os.path.getsize(path), 1000000)
+
+    def test_concurrent(self):
+        proc = self.helper.popen(['sh', '-c', 'sleep 3; cat > /dev/null'],
+                                 lambda name, line: None)
+        for _ in range(10):
+            proc.stdin.write('x' * 100000)
+        started = time.time()
+        out, _ = self.mgr._run_command(['echo', 'x'], helper=self.helper)
+        self.assertEqual(out, 'x\n')
+        self.assertLess(time.time() - started, 2)
+        proc.stdin.close()
+        self.assertEqual(proc.wait(), 0)
+
+
+class MockSudoStandaloneRunner(PuppetStandaloneRunner, PuppetDebianInstaller,
+                               PuppetManager):
+    """ Records commands instead of running them with sudo """
+
+    outputs = {}
+
+    def __init__(self, ctx):
+        super(MockSudoStandaloneRunner, self).__init__(ctx)
+        self.commands = []
+
+    def _sudo(self, *args, **kwargs):
+        self.commands.append(args)
+        return self.outputs.get(args[:3], ''), ''
+
+
+class MockSudoAgentRunner(PuppetAgentRunner, PuppetDebianInstaller,
+                          PuppetManager):
+    """ Fails the run script with the queued errors, then succeeds """
+
+    def __init__(self, ctx):
+        super(MockSudoAgentRunner, self).__init__(ctx)
+        self.errors = []
+        self.runs = 0
+
+    def _sudo(self, *args, **kwargs):
+        self.runs += 1
+        if self.errors:
+            raise SudoError(self.errors.pop(0))
+        return '', ''
+
+
+class PuppetAgentThrottlingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.addCleanup(setattr, puppet_plugin.manager, 'AGENT_TOKENS_DIR',
+                        puppet_plugin.manager.AGENT_TOKENS_DIR)
+        puppet_plugin.manager.AGENT_TOKENS_DIR = self.tmp_dir
+        self.sleeps = []
+        self.addCleanup(setattr, puppet_plugin.manager.time, 'sleep',
+                        puppet_plugin.manager.time.sleep)
+        puppet_plugin.manager.time.sleep = self.sleeps.append
+        ctx = make_context({
+            'server': 'puppet.example.com',
+            'environment': 'test',
+            'agent_concurrency': 2,
+            'master_retries': 2,
+        })
+        self.mgr = MockSudoAgentRunner(ctx)
+
+    def test_master_retries(self):
+        self.mgr.errors = [
+            'Could not retrieve catalog from remote server: '
+            'Error 503 on SERVER',
+            'Could not retrieve catalog from remote server: '
+            'execution expired',
+        ]
+        self.mgr.run_script('run.sh', capture=False)
+        self.assertEqual(self.mgr.runs, 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(5 <= self.sleeps[0] <= 10)
+        self.assertTrue(10 <= self.sleeps[1] <= 20)
+
+    def test_no_retry(self):
+        for error in (
+                'Could not find class apache',
+                'Exit code: 6\nError: /Stage[main]/App/Exec[fetch]/returns: '
+                'change from notrun to 0 failed: curl: (7) Failed to '
+                'connect to repo.example.com port 80: Connection refused',
+                'Could not retrieve catalog from remote server: Error 400 '
+                'on SERVER: Syntax error at \'}\'; expected \'}\' at '
+                '/etc/puppet/manifests/site.pp:3 on node node_name'):
+            self.mgr.runs = 0
+            self.mgr.errors = [error]
+            self.assertRaises(SudoError, self.mgr.run_script, 'run.sh', False)
+            self.assertEqual(self.mgr.runs, 1)
+            self.assertEqual(self.sleeps, [])
+
+    def test_failover(self):
+        self.mgr.servers = ['m1', 'm2']
+        self.mgr.server_policy = 'ordered'
+        self.mgr.errors = ['Could not retrieve catalog from remote server: '
+                           'Connection refused - connect(2)']
+        calls = []
+        orig_sudo = self.mgr._sudo
+
+        def sudo(*args, **kwargs):
+            calls.append(args)
+            return orig_sudo(*args, **kwargs)
+        self.mgr._sudo = sudo
+        self.mgr.run_script('run.sh', capture=False)
+        self.assertEqual(calls, [('run.sh', 'm1'), ('run.sh', 'm2')])
+        self.assertEqual(self.sleeps, [])
+
+    def test_server_hash(self):
+        self.mgr.servers = ['m1', 'm2', 'm3']
+        servers = self.mgr._order_servers()
+        self.assertEqual(sorted(servers), ['m1', 'm2', 'm3'])
+        self.assertEqual(servers, self.mgr._order_servers())
+
+    def test_tokens(self):
+        with self.mgr._agent_token():
+            with self.mgr._agent_token():
+                locked = []
+                for name in sorted(os.listdir(self.tmp_dir)):
+                    with open(os.path.join(self.tmp_dir, name)) as f:
+                        try:
+                            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except IOError:
+                            locked.append(name)
+                self.assertEqual(locked, ['0.lock', '1.lock'])
+
+
+class PuppetCertnameTest(unittest.TestCase):
+
+    def _make_mgr(self, runtime_properties=None, **props):
+        props.update({
+            'server': 'puppet.example.com',
+            'environment': 'test',
+        })
+        ctx = make_context(props, runtime_properties=runtime_properties)
+        return MockSudoAgentRunner(ctx)
+
+    def test_stable(self):
+        mgr = self._make_mgr(stable_certname=True)
+        self.assertEqual(mgr.get_certname(), 'node_id')
+
+    def test_reuse(self):
+        mgr = self._make_mgr(
+            runtime_properties={'puppet_certname': '201401010000-node_id'})
+        self.assertEqual(mgr.get_certname(), '201401010000-node_id')
+        mgr.errors = ['test: no certificate']
+        self.assertNotEqual(mgr.get_certname(), '201401010000-node_id')
+
+    def test_configure(self):
+        mgr = self._make_mgr(stable_certname=True,
+                             csr_attributes={'custom_attributes': {}})
+        written = {}
+        mgr._sudo_write_file = written.__setitem__
+        mgr.configure()
+        self.assertIn('certname = node_id\n',
+                      written['/etc/puppet/puppet.conf'])
+        self.assertEqual(json.loads(written[CSR_ATTRIBUTES_FILE]),
+                         {'custom_attributes': {}})
+        self.assertEqual(mgr.ctx.runtime_properties['puppet_certname'],
+                         'node_id')
+
+    def test_preseed_requires_stable(self):
+        ssl_preseed = {'certificate': '/ssl/node.pem',
+                       'private_key': '/ssl/node.key',
+                       'ca_certificate': '/ssl/ca.pem'}
+        self.assertRaises(PuppetParamsError, self._make_mgr,
+                          ssl_preseed=ssl_preseed)
+        self._make_mgr(ssl_preseed=ssl_preseed, stable_certname=True)
+
+
+class PuppetConfTest(unittest.TestCase):
+
+    EXISTING = (
+        '[main]\n'
+        '    # user managed\n'
+        '    logdir = /var/log/puppet\n'
+        '    server = old.example.com\n'
+        '\n'
+        '[master]\n'
+        '    reports = store\n'
+    )
+
+    def test_merge(self):
+        merged = merge_ini(self.EXISTING, parse_ini(
+            '[main]\nserver = new.example.com\nenvironment = e1\n'
+            '[agent]\ncertname = c1\n'))
+        self.assertEqual(merged, (
+            '[main]\n'
+            '    # user managed\n'
+            '    logdir = /var/log/puppet\n'
+            '    server = new.example.com\n'
+            '    environment = e1\n'
+            '\n'
+            '[master]\n'
+            '    reports = store\n'
+            '\n'
+            '[agent]\n'
+            '    certname = c1\n'))
+        self.assertEqual(merge_ini(merged, parse_ini(merged)), merged)
+
+
+class PuppetPackagesBundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_install_bundle(self):
+        bundle = os.path.join(self.tmp_dir, 'bundle.tar.gz')
+        with tarfile.open(bundle, 'w:gz') as tar:
+            for name in 'puppet.deb', 'deps/ruby.deb', 'README':
+                data = name.encode('ascii')
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        ctx = make_context({
+            'execute': {},
+            'download_cache': {'dir': os.path.join(self.tmp_dir, 'c')},
+        }, resources={'/bundle.tar.gz': bundle})
+        mgr = MockSudoStandaloneRunner(ctx)
+        mgr.install_packages_bundle('/bundle.tar.gz')
+        (cmd, ) = mgr.commands
+        self.assertEqual(cmd[:2], ('dpkg', '-i'))
+        self.assertEqual([os.path.basename(p) for p in cmd[2:]],
+                         ['ruby.deb', 'puppet.deb'])
+
+    def test_unsafe_bundle(self):
+        bundle = os.path.join(self.tmp_dir, 'bundle.tar.gz')
+        with tarfile.open(bundle, 'w:gz') as tar:
+            info = tarfile.TarInfo('../../puppet.deb')
+            tar.addfile(info, io.BytesIO(b''))
+            info = tarfile.TarInfo('lib')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '/usr/lib'
+            tar.addfile(info)
+        ctx = make_context({
+            'execute': {},
+            'download_cache': {'dir': os.path.join(self.tmp_dir, 'c')},
+        }, resources={'/bundle.tar.gz': bundle})
+        mgr = MockSudoStandaloneRunner(ctx)
+        with self.assertRaises(PuppetError) as cm:
+            mgr.install_packages_bundle('/bundle.tar.gz')
+        self.assertIn('../../puppet.deb, lib', str(cm.exception))
+        self.assertEqual(mgr.commands, [])
+
+
+class PuppetPackagesMirrorTest(ProcessCacheTestCase):
+
+    PROCESS_CACHE = {'distribution': ('Ubuntu', '14.04', 'trusty')}
+
+    def setUp(self):
+        super(PuppetPackagesMirrorTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.key = os.path.join(self.tmp_dir, 'mirror.key')
+        with open(self.key, 'w') as f:
+            f.write('key')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _install(self, **props):
+        props.update({'execute': {},
+                      'packages_mirror': 'http://mirror.example.com/apt'})
+        ctx = make_context(props, resources={'/mirror.key': self.key})
+        mgr = MockSudoStandaloneRunner(ctx)
+        written = {}
+        mgr._sudo_write_file = written.__setitem__
+        mgr.install_packages_from_repo()
+        return mgr.commands, written[mgr.MIRROR_SOURCES_LIST]
+
+    def test_unsigned(self):
+        self.assertRaises(PuppetParamsError, self._install)
+        _, sources = self._install(packages_mirror_unsigned=True)
+        self.assertEqual(sources, 'deb [trusted=yes] '
+                         'http://mirror.example.com/apt trusty main '
+                         'dependencies\n')
+
+    def test_key(self):
+        commands, sources = self._install(packages_mirror_key='/mirror.key')
+        self.assertEqual(commands[0][:2], ('apt-key', 'add'))
+        self.assertEqual(sources, 'deb http://mirror.example.com/apt trusty '
+                         'main dependencies\n')
+
+
+class PuppetPackagesCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orig = {}
+        for name in 'APT_LISTS_DIR', 'APT_SOURCES_LIST', 'APT_SOURCES_PARTS':
+            self.orig[name] = getattr(puppet_plugin.manager, name)
+            path = os.path.join(self.tmp_dir, name)
+            setattr(puppet_plugin.manager, name, path)
+        os.mkdir(puppet_plugin.manager.APT_SOURCES_PARTS)
+        open(puppet_plugin.manager.APT_SOURCES_LIST, 'w').close()
+        os.mkdir(puppet_plugin.manager.APT_LISTS_DIR)
+        ctx = make_context({'execute': {}})
+        self.mgr = MockSudoStandaloneRunner(ctx)
+
+    def tearDown(self):
+        for name, value in self.orig.items():
+            setattr(puppet_plugin.manager, name, value)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fresh(self):
+        self.assertTrue(self.mgr.packages_cache_is_fresh(60))
+        self.assertFalse(self.mgr.packages_cache_is_fresh(-1))
+        sources = os.path.join(puppet_plugin.manager.APT_SOURCES_PARTS,
+                               'puppetlabs.list')
+        open(sources, 'w').close()
+        now = time.time()
+        os.utime(puppet_plugin.manager.APT_LISTS_DIR, (now - 10, now - 10))
+        self.assertFalse(self.mgr.packages_cache_is_fresh(60))
+
+    def test_no_sources(self):
+        os.remove(puppet_plugin.manager.APT_SOURCES_LIST)
+        self.assertFalse(self.mgr.packages_cache_is_fresh(60))
+
+    def test_install_packages(self):
+        self.mgr.install_packages([('puppet', '3.5.1'), ('ruby-json', None)])
+        self.assertEqual(self.mgr.commands, [
+            ('apt-get', 'install', '-y', 'puppet=3.5.1', 'ruby-json')])
+
+
+class PuppetImageManifestTest(ProcessCacheTestCase):
+
+    def setUp(self):
+        super(PuppetImageManifestTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.tmp_dir, 'puppet-image.json')
+        with open(puppet_plugin.manager.CUSTOM_FACTS_FILE, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with open(self.manifest, 'w') as f:
+            json.dump({
+                'puppet_version': '3.5.1-1puppetlabs1',
+                'modules': ['puppetlabs/stdlib'],
+                'facts_plugin_sha256': digest,
+            }, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_manager(self, node_id='node_id', **props):
+        props.update({'execute': {}, 'image_manifest': self.manifest})
+        ctx = make_context(props, node_id=node_id)
+        return MockSudoStandaloneRunner(ctx)
+
+    def test_prebaked(self):
+        mgr = self._make_manager(modules=['puppetlabs-stdlib'])
+        mgr.install()
+        mgr.install()
+        self.assertEqual(mgr.commands, [])
+
+    def test_prebaked_instances(self):
+        configured = []
+        for node_id in ('node_1', 'node_2'):
+            mgr = self._make_manager(node_id=node_id)
+            mgr.configure = lambda mgr=mgr: configured.append(mgr.ctx.node_id)
+            mgr.install()
+            self.assertEqual(mgr.commands, [])
+        self.assertEqual(configured, ['node_1', 'node_2'])
+
+    def test_version_mismatch(self):
+        mgr = self._make_manager(version='3.7.0-1puppetlabs1')
+        self.assertIsNone(mgr.get_image_manifest())
+
+
+class PuppetModulesTest(unittest.TestCase):
+
+    MODULE_LIST = (
+        "/etc/puppet/modules\n"
+        "\xe2\x94\x9c\xe2\x94\x80\xe2\x94\x80 puppetlabs-stdlib (v4.1.0)\n"
+        "/usr/share/puppet/modules (no modules installed)\n"
+    )
+    APACHE_INSTALL = (
+        "Notice: Preparing to install into /etc/puppet/modules ...\n"
+        "/etc/puppet/modules\n"
+        "\xe2\x94\x94\xe2\x94\x80\xe2\x94\xac puppetlabs-apache (v1.0.1)\n"
+        "  \xe2\x94\x94\xe2\x94\x80\xe2\x94\x80 puppetlabs-concat (v1.0.2)\n"
+    )
+
+    def _make_runner(self, modules):
+        ctx = make_context({
+            'modules': modules,
+            'execute': {},
+        }, operation='cloudify.interfaces.lifecycle.configure')
+        runner = MockSudoStandaloneRunner(ctx)
+        runner.outputs = {
+            ('puppet', 'module', 'list'): self.MODULE_LIST,
+            ('puppet', 'module', 'install'): self.APACHE_INSTALL,
+        }
+        return runner
+
+    def test_parse_module_names(self):
+        self.assertEqual(parse_module_names(self.MODULE_LIST),
+                         set(['puppetlabs-stdlib']))
+        self.assertEqual(parse_module_names(self.APACHE_INSTALL),
+                         set(['puppetlabs-apache', 'puppetlabs-concat']))
+
+    def test_install_modules(self):
+        runner = self._make_runner([
+            'puppetlabs-stdlib',
+            'puppetlabs/apache',
+            'puppetlabs-concat',
+        ])
+        report = runner.install_modules(runner.props['modules'])
+        self.assertEqual(report['installed'], ['puppetlabs/apache'])
+        self.assertEqual(report['skipped'],
+                         ['puppetlabs-stdlib', 'puppetlabs-concat'])
+        lists = [c for c in runner.commands if c[:3] == (
+            'puppet', 'module', 'list')]
+        self.assertEqual(len(lists), 1)
+
+
+class MockFingerprintStandaloneRunner(MockSudoStandaloneRunner):
+
+    files_fingerprint = 'f1'
+
+    def install(self):
+        pass
+
+    def _paths_fingerprint(self, paths):
+        return self.files_fingerprint
+
+
+class PuppetRunFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_state_dir = puppet_plugin.manager.RUN_STATE_DIR
+        self.dir = tempfile.mkdtemp()
+        puppet_plugin.manager.RUN_STATE_DIR = os.path.join(self.dir, 'runs')
+
+    def tearDown(self):
+        puppet_plugin.manager.RUN_STATE_DIR = self.orig_state_dir
+        shutil.rmtree(self.dir)
+
+    def _run(self, props):
+        ctx = make_context(
+            props, operation='cloudify.interfaces.lifecycle.start')
+        runner = MockFingerprintStandaloneRunner(ctx)
+        runner.run(execute='notice("x")')
+        return [c for c in runner.commands if c[0].endswith('.run.sh')]
+
+    def test_skip_unchanged(self):
+        props = {'execute': {}, 'run_fingerprint': True}
+        self.assertEqual(len(self._run(props)), 1)
+        self.assertEqual(len(self._run(props)), 0)
+
+        MockFingerprintStandaloneRunner.files_fingerprint = 'f2'
+        try:
+            self.assertEqual(len(self._run(props)), 1)
+        finally:
+            MockFingerprintStandaloneRunner.files_fingerprint = 'f1'
+
+        props['run_fingerprint'] = {'force': True}
+        self.assertEqual(len(self._run(props)), 1)
+
+
+class PuppetRunReportTest(unittest.TestCase):
+
+    def test_publish_run_report(self):
+        ctx = make_context({
+            'execute': {},
+            'run_report': {'top': 1},
+        }, operation='cloudify.interfaces.lifecycle.start')
+        runner = MockSudoStandaloneRunner(ctx)
+        runner.outputs = {
+            ('ruby', puppet_plugin.manager.REPORT_SUMMARY_SCRIPT,
+             puppet_plugin.manager.PUPPET_LAST_RUN_REPORT):
+            '{"status": "changed", "resources": {"failed": 0}}\n',
+        }
+        runner.publish_run_report('Notice: Finished\nExit code: 2\n')
+        self.assertEqual(ctx.runtime_properties['puppet_last_run'], {
+            'operation': 'cloudify.interfaces.lifecycle.start',
+            'exit_code': 2,
+            'status': 'changed',
+            'resources': {'failed': 0},
+        })
+        self.assertEqual(runner.commands[0][-1], '1')
+
+    def test_stale_run_report(self):
+        ctx = make_context({
+            'execute': {},
+            'run_report': True,
+        }, operation='cloudify.interfaces.lifecycle.start')
+        runner = MockSudoStandaloneRunner(ctx)
+        runner.outputs = {
+            ('ruby', puppet_plugin.manager.REPORT_SUMMARY_SCRIPT,
+             puppet_plugin.manager.PUPPET_LAST_RUN_REPORT):
+            '{"status": "changed", "report_time": 1000.5}\n',
+        }
+        runner.publish_run_report('Exit code: 1\n', started=1000)
+        self.assertEqual(ctx.runtime_properties['puppet_last_run'], {
+            'operation': 'cloudify.interfaces.lifecycle.start',
+            'exit_code': 1,
+            'status': 'changed',
+        })
+        runner.publish_run_report('Exit code: 1\n', started=2000)
+        self.assertEqual(ctx.runtime_properties['puppet_last_run'], {
+            'operation': 'cloudify.interfaces.lifecycle.start',
+            'exit_code': 1,
+            'report_stale': True,
+        })
+
+
+class PuppetProfileTest(unittest.TestCase):
+
+    OUTPUT = (
+        "Info: PROFILE [apply] 1.1 Evaluated resource Class[Apache]: "
+        "took 0.5000 seconds\n"
+        "Info: PROFILE [apply] 1.2 Evaluated resource Apache::Vhost[a]: "
+        "took 0.2000 seconds\n"
+        "Info: PROFILE [apply] 1.3 Called template: took 0.1000 seconds\n"
+        "Info: PROFILE [apply] 1.4 Called template: took 0.3000 seconds\n"
+        "Info: /Stage[main]/Apache/Package[httpd]: "
+        "Evaluated in 2.31 seconds\n"
+        "Notice: Finished catalog run in 3.00 seconds\n"
+    )
+
+    def test_parse_profile(self):
+        profile = parse_profile(self.OUTPUT)
+        self.assertEqual(profile, {
+            ('class', 'Class[Apache]'): [1, 0.5],
+            ('defined type', 'Apache::Vhost[a]'): [1, 0.2],
+            ('function', 'template'): [2, 0.4],
+            ('resource', 'Package[httpd]'): [1, 2.31],
+        })
+        table = format_profile_table(profile, 10)
+        self.assertIn('RESOURCE', table)
+        self.assertRegexpMatches(table, r'0\.4000\s+2\s+template')
+
+
+class PuppetFactsTest(unittest.TestCase):
+
+    FACTS = {
+        'role': 'web',
+        'cloudify': {
+            'node_id': 'n1',
+            'properties': {'port': 80, 'ssl': True, 'names': ['a', 'b']},
+            'runtime_properties': {'x': None},
+        },
+    }
+
+    def test_flatten(self):
+        self.assertEqual(flatten_facts(self.FACTS), {
+            'role': 'web',
+            'cloudify_node_id': 'n1',
+            'cloudify_properties_port': '80',
+            'cloudify_properties_ssl': 'true',
+            'cloudify_properties_names': '["a", "b"]',
+            'cloudify_runtime_properties_x': '',
+        })
+
+    def test_select(self):
+        selected = select_facts(self.FACTS,
+                                include=['role', 'cloudify_properties_'],
+                                exclude=['cloudify_properties_names'])
+        self.assertEqual(selected, {
+            'role': 'web',
+            'cloudify': {
+                'properties': {'port': 80, 'ssl': True},
+            },
+        })
+
+    def test_bound(self):
+        facts = {'a': 'x' * 10, 'b': {'c': 'y' * 20, 'd': 'z'}}
+        self.assertEqual(bound_facts(facts, max_value_size=15),
+                         [('b_c', 20)])
+        self.assertEqual(facts['b']['c'], 'y' * 15)
+        self.assertEqual(bound_facts(facts, max_size=20), [('b_c', 15)])
+        self.assertEqual(facts, {'a': 'x' * 10, 'b': {'d': 'z'}})
+
+    def test_lazy_context(self):
+        class Ctx(object):
+            node_id = 'n1'
+
+            @property
+            def capabilities(self):
+                raise AssertionError("capabilities were fetched")
+
+        self.assertEqual(
+            puppet_plugin.manager._context_to_struct(
+                Ctx(), include=['cloudify_node_id']),
+            {'node_id': 'n1'})
+
+    def test_external(self):
+        self.assertEqual(
+            format_external_facts({'b': u'x\ny', 'a': u'\xe9'}),
+            'a=\xc3\xa9\nb=x\\ny\n')
+
+    def test_external_agent_daemon(self):
+        ctx = make_context({
+            'server': 'puppet.example.com',
+            'environment': 'test',
+            'agent_daemon': True,
+            'facts_format': 'external',
+        })
+        script = MockSudoAgentRunner(ctx).get_run_script(
+            'puppet agent --onetime', '/tmp/facts', '', [])
+        self.assertIn('flock 9\n', script)
+        # The daemon outlives the script, it must not keep the lock
+        (daemon_line, ) = [line for line in script.splitlines()
+                           if '--runinterval' in line]
+        self.assertTrue(daemon_line.endswith(' 9>&-'))
+
+
+class MockResourcesContext(object):
+    """ Serves blueprint resources from a dict """
+
+    def __init__(self, resources):
+        self.resources = resources
+
+    def download_resource(self, path, target_path):
+        with open(target_path, 'wb') as f:
+            f.write(self.resources[path])
+        return target_path
+
+
+class DownloadCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = DownloadCache(logging.getLogger(__name__),
+                                   os.path.join(self.dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resource(self):
+        ctx = MockResourcesContext({'/a.tar.gz': 'A' * 10})
+        path1, digest1 = self.cache.fetch_resource(ctx, '/a.tar.gz')
+        path2, digest2 = self.cache.fetch_resource(ctx, '/a.tar.gz')
+        self.assertEqual((path1, digest1), (path2, digest2))
+        with open(path1) as f:
+            self.assertEqual(f.read(), 'A' * 10)
+
+        ctx.resources['/a.tar.gz'] = 'B' * 10
+        _, digest3 = self.cache.fetch_resource(ctx, '/a.tar.gz')
+        self.assertNotEqual(digest1, digest3)
+
+    def test_extracted(self):
+        self.assertFalse(self.cache.is_extracted(self.dir, ['d1']))
+        self.cache.set_extracted(self.dir, ['d1', 'd2'])
+        self.assertTrue(self.cache.is_extracted(self.dir, ['d1', 'd2']))
+        self.assertFalse(self.cache.is_extracted(self.dir, ['d2', 'd1']))
+
+    def test_evict(self):
+        self.cache.max_size = 15
+        ctx = MockResourcesContext({'/a': 'A' * 10, '/b': 'B' * 10})
+        path_a, _ = self.cache.fetch_resource(ctx, '/a')
+        path_b, _ = self.cache.fetch_resource(ctx, '/b')
+        self.cache.evict()
+        self.assertFalse(os.path.exists(path_a))
+        self.assertTrue(os.path.exists(path_b))
+
+
+class ArchivesDeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _make_archive(self, name, files):
+        path = os.path.join(self.dir, name)
+        with tarfile.open(path, 'w:gz') as tar:
+            for file_name, contents in files.items():
+                info = tarfile.TarInfo('puppet/' + file_name)
+                info.size = len(contents)
+                tar.addfile(info, io.BytesIO(contents))
+        return path
+
+    def _delta(self, archives, previous):
+        out = io.BytesIO()
+        tree, changed, deleted = write_archives_delta(
+            archives, 'puppet', previous, lambda: out)
+        out.seek(0)
+        names = []
+        if changed:
+            names = tarfile.open(fileobj=out).getnames()
+        return tree, changed, deleted, names
+
+    def test_delta(self):
+        a1 = self._make_archive('a1.tar.gz', {'site.pp': '1', 'x.pp': 'x'})
+        a2 = self._make_archive('a2.tar.gz', {'site.pp': '2'})
+        tree, changed, deleted, names = self._delta([a1, a2], {})
+        self.assertEqual(changed, ['site.pp', 'x.pp'])
+        self.assertEqual(sorted(names), changed)
+
+        _, changed, deleted, _ = self._delta([a1, a2], tree)
+        self.assertEqual((changed, deleted), ([], []))
+
+        a3 = self._make_archive('a3.tar.gz', {'site.pp': '3'})
+        _, changed, deleted, names = self._delta([a3], tree)
+        self.assertEqual(changed, ['site.pp'])
+        self.assertEqual(deleted, ['x.pp'])
+        self.assertEqual(names, ['site.pp'])
+
+
+class MockResponse(object):
+
+    def __init__(self, status_code, body, headers=None, fail_at=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.fail_at = fail_at
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            if self.fail_at is not None and i >= self.fail_at:
+                raise requests.ConnectionError("Connection reset")
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class StreamDownloadTest(unittest.TestCase):
+
+    body = 'x' * 1000
+
+    def setUp(self):
+        self.orig_get = puppet_plugin.downloads.requests.get
+        self.requests_headers = []
+        puppet_plugin.downloads.requests.get = self._get
+
+    def tearDown(self):
+        puppet_plugin.downloads.requests.get = self.orig_get
+
+    def _get(self, url, headers=None, stream=False):
+        self.requests_headers.append(headers)
+        if 'Range' in headers:
+            offset = int(headers['Range'][len('bytes='):-1])
+            return MockResponse(206, self.body[offset:])
+        return MockResponse(200, self.body, {
+            'Content-Length': str(len(self.body)),
+            'ETag': '"etag1"',
+        }, fail_at=300)
+
+    def test_resume(self):
+        f = io.BytesIO()
+        response, digest = stream_download(
+            'http://example.com/x.tar.gz', f, chunk_size=100,
+            expected_digest=hashlib.sha256(self.body).hexdigest())
+        self.assertEqual(f.getvalue(), self.body)
+        self.assertEqual(self.requests_headers[1], {
+            'Range': 'bytes=300-',
+            'If-Range': '"etag1"',
+        })
+
+
+class MockLocalStandaloneRunner(PuppetStandaloneRunner, PuppetDebianInstaller,
+                                PuppetManager):
+    """ Runs commands as the current user instead of with sudo """
+
+    def _sudo(self, *args, **kwargs):
+        return self._run_command(list(args), **kwargs)
+
+    def _sudo_popen(self, cmd):
+        return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+
+class StreamToDirTest(unittest.TestCase):
+
+    url = 'http://example.com/repo.tar.gz'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dst_dir = os.path.join(self.tmp_dir, 'repo')
+        os.mkdir(self.dst_dir)
+        with open(os.path.join(self.dst_dir, 'old.pp'), 'w') as f:
+            f.write('old')
+        self._set_archive({'new.pp': b'new'})
+        self.orig_get = puppet_plugin.downloads.requests.get
+        puppet_plugin.downloads.requests.get = self._get
+
+    def tearDown(self):
+        puppet_plugin.downloads.requests.get = self.orig_get
+        shutil.rmtree(self.tmp_dir)
+
+    def _set_archive(self, files):
+        """ Serves a .tar.gz of {path: data} at self.url """
+        body = io.BytesIO()
+        with tarfile.open(fileobj=body, mode='w:gz') as tar:
+            for path, data in sorted(files.items()):
+                info = tarfile.TarInfo('repo/' + path)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        self.body = body.getvalue()
+        self.digest = hashlib.sha256(self.body).hexdigest()
+
+    def _read(self, path):
+        with open(os.path.join(self.dst_dir, path)) as f:
+            return f.read()
+
+    def _get(self, url, headers=None, stream=False):
+        return MockResponse(200, self.body)
+
+    def _make_mgr(self, **props):
+        props.update({
+            'execute': {},
+            'download_cache': {'dir': os.path.join(self.tmp_dir, 'cache')},
+        })
+        ctx = make_context(props)
+        return MockLocalStandaloneRunner(ctx)
+
+    def test_stream(self):
+        mgr = self._make_mgr(download_streaming=True)
+        self.assertIsNone(mgr._urls_to_dir([self.url], self.dst_dir))
+        self.assertEqual(sorted(os.listdir(self.dst_dir)),
+                         ['new.pp', 'old.pp'])
+
+    def test_checksum(self):
+        mgr = self._make_mgr(download_streaming=True,
+                             download_checksums={self.url: self.digest})
+        mgr._urls_to_dir([self.url], self.dst_dir)
+        self.assertEqual(sorted(os.listdir(self.dst_dir)),
+                         ['new.pp', 'old.pp'])
+        # The staging directory is removed
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['cache', 'repo'])
+
+    def test_checksum_mismatch(self):
+        mgr = self._make_mgr(download_streaming=True,
+                             download_checksums={self.url: '0' * 64})
+        with self.assertRaises(PuppetError):
+            mgr._urls_to_dir([self.url], self.dst_dir)
+        self.assertEqual(os.listdir(self.dst_dir), ['old.pp'])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['cache', 'repo'])
+
+    def test_cache(self):
+        mgr = self._make_mgr()
+        mgr._urls_to_dir([self.url], self.dst_dir)
+        os.remove(os.path.join(self.dst_dir, 'new.pp'))
+        # Extracted by the cached path, then streamed: the cache must not
+        # consider the archive extracted any more
+        self._make_mgr(download_streaming=True)._urls_to_dir(
+            [self.url], self.dst_dir)
+        os.remove(os.path.join(self.dst_dir, 'new.pp'))
+        mgr._urls_to_dir([self.url], self.dst_dir)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dst_dir, 'new.pp')))
+
+    def test_switch_modes(self):
+        v1 = {'a.pp': b'a1', 'b.pp': b'b1'}
+        self._set_archive(v1)
+        self._make_mgr(download_delta_sync=True)._urls_to_dir(
+            [self.url], self.dst_dir)
+        # A full extraction leaves the recorded tree unknown
+        self._set_archive({'a.pp': b'a2'})
+        self._make_mgr()._urls_to_dir([self.url], self.dst_dir)
+        self.assertEqual(self._read('a.pp'), 'a2')
+        self._set_archive(v1)
+        changes = self._make_mgr(download_delta_sync=True)._urls_to_dir(
+            [self.url], self.dst_dir)
+        self.assertEqual(self._read('a.pp'), 'a1')
+        self.assertEqual(changes['deleted'], [])
+
+
+class MockTask(object):
+
+    def __init__(self, error, delay=0):
+        self.error = error
+        self.delay = delay
+
+    def get(self, retry_on_failure=True):
+        # Cloudify retries failed tasks forever by default
+        assert not retry_on_failure
+        time.sleep(self.delay)
+        if self.error:
+            raise RuntimeError(self.error)
+
+
+class MockNodeInstance(object):
+    """ Puppet fails on node instances with failing=True and takes
+    `delay` seconds """
+
+    def __init__(self, instance_id, started, failing=False, delay=0):
+        self.id = instance_id
+        self.node_id = 'node'
+        self.started = started
+        self.failing = failing
+        self.delay = delay
+
+    def execute_operation(self, operation, kwargs=None):
+        self.started.append(self.id)
+        return MockTask(self.failing and 'puppet failed', self.delay)
+
+
+class PuppetWorkflowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = MockCloudifyContext()
+        self.started = []
+
+    def test_converge(self):
+        instances = [MockNodeInstance(str(i), self.started)
+                     for i in range(5)]
+        instances[1].failing = True
+        results, aborted = converge(self.ctx, instances, concurrency=2,
+                                    batch_size=2, max_failure_percentage=20)
+        self.assertFalse(aborted)
+        self.assertEqual(self.started, ['0', '1', '2', '3', '4'])
+        self.assertEqual(results['1']['status'], 'failed')
+        self.assertEqual(results['1']['error'], 'puppet failed')
+        self.assertEqual(results['4']['status'], 'ok')
+
+    def test_slow_instance(self):
+        instances = [MockNodeInstance(str(i), self.started, delay=0.05)
+                     for i in range(5)]
+        instances[0].delay = 1
+        results, aborted = converge(self.ctx, instances, concurrency=2)
+        self.assertFalse(aborted)
+        # The other instances ran in the second slot meanwhile
+        for i in range(1, 5):
+            self.assertLess(results[str(i)]['seconds'], 0.5)
+        self.assertGreater(results['0']['seconds'], 0.9)
+
+    def test_abort(self):
+        instances = [MockNodeInstance(str(i), self.started, failing=True)
+                     for i in range(5)]
+        results, aborted = converge(self.ctx, instances, concurrency=2)
+        self.assertTrue(aborted)
+        # The run which was already started is waited for
+        self.assertEqual(self.started, ['0', '1'])
+        table = format_results_table(results)
+        self.assertEqual(table.splitlines()[1:], [
+            'failed         0.0  0 puppet failed',
+            'failed         0.0  1 puppet failed',
+            'skipped          -  2',
+            'skipped          -  3',
+            'skipped          -  4',
+        ])
+
+    def test_invalid_limits(self):
+        instances = [MockNodeInstance('0', self.started)]
+        for kwargs in ({'concurrency': 0}, {'concurrency': -1},
+                       {'batch_size': -2}):
+            self.assertRaises(ValueError, converge, self.ctx, instances,
+                              **kwargs)
+        self.assertEqual(self.started, [])
+
+
+class MockSudoRHELRunner(PuppetStandaloneRunner, PuppetRHELInstaller,
+                         PuppetManager):
+    """ Records commands instead of running them with sudo """
+
+    def __init__(self, ctx):
+        super(MockSudoRHELRunner, self).__init__(ctx)
+        self.commands = []
+
+    def _sudo(self, *args, **kwargs):
+        self.commands.append(args)
+        return '', ''
+
+
+class PuppetRHELInstallerTest(ProcessCacheTestCase):
+    """ Installs from a fake yum.puppetlabs.com """
+
+    REPO = {
+        'http://yum.puppetlabs.com/puppetlabs-release-el-7.noarch.rpm':
+        'release-el-7',
+        'http://mirror.example.com/release-el-6.rpm': 'release-el-6',
+    }
+
+    PROCESS_CACHE = {
+        'distribution': ('CentOS Linux', '7.2.1511', 'Core'),
+        'rpm_package_manager': 'yum',
+        'puppet_installed': False,
+    }
+
+    def setUp(self):
+        super(PuppetRHELInstallerTest, self).setUp()
+        self.orig_head = requests.head
+        self.orig_get = requests.get
+        requests.head = self._head
+        requests.get = self._get
+        self.downloaded = []
+
+    def tearDown(self):
+        requests.head = self.orig_head
+        requests.get = self.orig_get
+
+    def _head(self, url):
+        return MockResponse(200 if url in self.REPO else 404, '')
+
+    def _get(self, url, headers=None, stream=False):
+        self.downloaded.append(url)
+        if url not in self.REPO:
+            return MockResponse(404, '')
+        return MockResponse(200, self.REPO[url])
+
+    def _make_manager(self, **props):
+        props['execute'] = {}
+        ctx = make_context(props)
+        return MockSudoRHELRunner(ctx)
+
+    def test_handles(self):
+        self.assertTrue(PuppetRHELInstaller._installer_handles())
+        puppet_plugin.manager._PROCESS_CACHE['distribution'] = (
+            'Ubuntu', '14.04', 'trusty')
+        self.assertFalse(PuppetRHELInstaller._installer_handles())
+
+    def test_install(self):
+        mgr = self._make_manager(packages_cache_max_age=3600)
+        mgr.install()
+        self.assertEqual(self.downloaded, [
+            'http://yum.puppetlabs.com/puppetlabs-release-el-7.noarch.rpm'])
+        self.assertEqual(mgr.commands[0][:3],
+                         ('rpm', '-Uvh', '--replacepkgs'))
+        self.assertEqual(mgr.commands[1:3], [
+            ('yum', 'makecache', '--setopt=metadata_expire=3600'),
+            ('yum', 'install', '-y', '--setopt=metadata_expire=3600',
+             'puppet-3.5.1', 'rubygem-json'),
+        ])
+
+    def test_repos_override(self):
+        puppet_plugin.manager._PROCESS_CACHE['distribution'] = (
+            'CentOS', '6.5', 'Final')
+        mgr = self._make_manager(repos={'rpm': {
+            6: 'http://mirror.example.com/release-el-6.rpm'}})
+        self.assertEqual(mgr.get_repo_package_url(),
+                         'http://mirror.example.com/release-el-6.rpm')
+        mgr.install()
+        self.assertEqual(mgr.commands[1], ('yum', 'makecache'))
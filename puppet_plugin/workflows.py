@@ -0,0 +1,150 @@
+""" Puppet plugin workflows. They run on the manager and trigger
+puppet_plugin.operations.run on the hosts. """
+
+import collections
+import Queue
+import threading
+import time
+
+from cloudify.decorators import workflow
+
+RUN_OPERATION = 'cloudify.interfaces.puppet.run'
+DEFAULT_CONCURRENCY = 10
+
+
+def select_instances(ctx, node_ids=None, node_instance_ids=None):
+    """ Node instances which have the Puppet run operation, optionally
+    only of the given nodes or with the given ids """
+    ret = []
+    for node in ctx.nodes:
+        if RUN_OPERATION not in node.operations:
+            continue
+        if node_ids and node.id not in node_ids:
+            continue
+        for instance in node.instances:
+            if node_instance_ids and instance.id not in node_instance_ids:
+                continue
+            ret.append(instance)
+    return ret
+
+
+def _wait_task(instance, started, task, done):
+    """ Waits for `task` and puts (instance, started, error) in `done`.
+    Failed runs are not retried, they count against
+    max_failure_percentage. """
+    error = None
+    try:
+        task.get(retry_on_failure=False)
+    except Exception as exc:
+        error = str(exc) or type(exc).__name__
+    done.put((instance, started, error))
+
+
+def converge(ctx, instances, kwargs=None, concurrency=DEFAULT_CONCURRENCY,
+             batch_size=None, max_failure_percentage=0):
+    """
+    Runs Puppet on `instances`, in batches of `batch_size` instances (all
+    at once if None or 0), at most `concurrency` at a time. Once more than
+    `max_failure_percentage` of all the instances failed, no more runs
+    are started.
+    Returns ({instance id: result}, aborted), where a result has 'node_id',
+    'status' ('ok', 'failed' or 'skipped'), 'seconds' and 'error'.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1, you gave "
+                         "{0}".format(concurrency))
+    if batch_size is not None and batch_size < 0:
+        raise ValueError("batch_size must be at least 1, or 0 for a single "
+                         "batch, you gave {0}".format(batch_size))
+    results = {}
+    for instance in instances:
+        results[instance.id] = {
+            'node_id': instance.node_id,
+            'status': 'skipped',
+            'seconds': None,
+            'error': '',
+        }
+    total = len(instances)
+    batch_size = batch_size or total
+    failed = 0
+    aborted = False
+    # Each running task is waited for by a thread of its own so that
+    # whichever finishes first frees its slot
+    done = Queue.Queue()
+    running = 0
+    for start in range(0, total, batch_size):
+        batch = collections.deque(instances[start:start + batch_size])
+        ctx.logger.info("Running Puppet on node instances {0}-{1} "
+                        "of {2}".format(start + 1, start + len(batch), total))
+        while running or (batch and not aborted):
+            while batch and not aborted and running < concurrency:
+                instance = batch.popleft()
+                task = instance.execute_operation(RUN_OPERATION,
+                                                  kwargs=kwargs)
+                waiter = threading.Thread(
+                    target=_wait_task,
+                    args=(instance, time.time(), task, done))
+                waiter.daemon = True
+                waiter.start()
+                running += 1
+            instance, started, error = done.get()
+            running -= 1
+            result = results[instance.id]
+            result['seconds'] = time.time() - started
+            if error is None:
+                result['status'] = 'ok'
+            else:
+                result['status'] = 'failed'
+                result['error'] = error
+                failed += 1
+            if not aborted and failed * 100 > max_failure_percentage * total:
+                aborted = True
+                ctx.logger.error(
+                    "Puppet failed on {0} of {1} node instances, more than "
+                    "{2}%. Not starting any more runs.".format(
+                        failed, total, max_failure_percentage))
+        if aborted:
+            break
+    return results, aborted
+
+
+def format_results_table(results):
+    """ Table of per node instance results, failures first """
+    order = {'failed': 0, 'skipped': 1, 'ok': 2}
+    lines = ['{0:8}  {1:>8}  {2}'.format('status', 'seconds',
+                                         'node instance')]
+    for instance_id, result in sorted(
+            results.items(),
+            key=lambda item: (order[item[1]['status']], item[0])):
+        seconds = result['seconds']
+        lines.append('{0:8}  {1:>8}  {2}{3}'.format(
+            result['status'],
+            '-' if seconds is None else '{0:.1f}'.format(seconds),
+            instance_id,
+            ' ' + result['error'] if result['error'] else ''))
+    return '\n'.join(lines) + '\n'
+
+
+@workflow
+def run_puppet(ctx, node_ids=None, node_instance_ids=None,
+               puppet_operation='start', concurrency=DEFAULT_CONCURRENCY,
+               batch_size=None, max_failure_percentage=0, **kwargs):
+    """ Runs Puppet on many node instances, see converge() """
+    instances = select_instances(ctx, node_ids, node_instance_ids)
+    if not instances:
+        ctx.logger.info("No node instances with the {0} operation".format(
+            RUN_OPERATION))
+        return
+    results, aborted = converge(
+        ctx, instances, kwargs={'puppet_operation': puppet_operation},
+        concurrency=int(concurrency),
+        batch_size=int(batch_size) if batch_size else None,
+        max_failure_percentage=float(max_failure_percentage))
+    ctx.logger.info("Puppet runs:\n" + format_results_table(results))
+    failed = [i for i, r in results.items() if r['status'] == 'failed']
+    if aborted:
+        raise RuntimeError("Puppet failed on node instances: {0}".format(
+            ', '.join(sorted(failed))))
+    if failed:
+        ctx.logger.warn("Puppet failed on node instances: {0}".format(
+            ', '.join(sorted(failed))))
@@ -32,7 +32,8 @@ setuptools.setup(
     ],
     package_data={
         'puppet_plugin': [
-            'puppet/facts/cloudify_facts.rb'
+            'puppet/facts/cloudify_facts.rb',
+            'puppet/report_summary.rb',
         ]
     },
 )